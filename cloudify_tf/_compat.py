@@ -32,6 +32,10 @@ def exec_(code, globs):
     exec code in globs
 """)
     PermissionDenied = OSError
+    from base64 import encodestring as encodebytes
+    from urlparse import urlparse
+    # The output of subprocesses is read by a thread per pipe instead.
+    selectors = None
 
 
     def mkdir_p(path):
@@ -53,6 +57,9 @@ else:
     text_type = str
     exec_ = getattr(builtins, 'exec')
     PermissionDenied = PermissionError
+    from base64 import encodebytes
+    from urllib.parse import urlparse
+    import selectors
 
     def mkdir_p(path):
         import pathlib
@@ -60,4 +67,4 @@ else:
 
 __all__ = [
     'PY2', 'StringIO', 'reraise', 'text_type', 'exec_', 'PermissionDenied',
-    'mkdir_p']
+    'mkdir_p', 'encodebytes', 'urlparse', 'selectors']
@@ -2,7 +2,10 @@ from functools import wraps
 
 from .terraform import Terraform
 from .utils import (is_using_existing,
-                    get_terraform_source)
+                    get_terraform_source,
+                    buffer_instance_updates,
+                    record_parallelism,
+                    flush_instance_updates)
 
 
 def with_terraform(func):
@@ -34,7 +37,10 @@ def with_terraform(func):
         with get_terraform_source() as terraform_source:
             tf = Terraform.from_ctx(ctx, terraform_source)
             kwargs['tf'] = tf
-            return func(*args, **kwargs)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                record_parallelism(tf)
     return f
 
 
@@ -44,3 +50,16 @@ def skip_if_existing(func):
         if not is_using_existing():
             return func(*args, **kwargs)
     return f
+
+
+def with_buffered_updates(func):
+    """Send the runtime properties that the operation changed to the
+    manager once, when it ends, instead of on every change."""
+    @wraps(func)
+    def f(*args, **kwargs):
+        buffer_instance_updates()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            flush_instance_updates()
+    return f
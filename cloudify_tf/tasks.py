@@ -24,11 +24,13 @@ from . import utils
 from ._compat import mkdir_p
 from .decorators import (
     with_terraform,
-    skip_if_existing)
-from .terraform import Terraform
+    skip_if_existing,
+    with_buffered_updates)
+from .terraform import Terraform, SAVED_PLAN
 
 
 @operation
+@with_buffered_updates
 @with_terraform
 def apply(ctx, tf, **_):
     """
@@ -42,11 +44,24 @@ def apply(ctx, tf, **_):
         _apply(tf)
 
 
+def _get_fingerprint(tf):
+    return utils.get_terraform_fingerprint(
+        tf.root_module, tf.variables, tf.env, tf.binary_path)
+
+
 def _apply(tf):
     try:
         tf.init()
-        tf.plan()
-        tf.apply()
+        # Apply the saved plan, rather than planning all over again.
+        plan_file = os.path.join(tf.root_module, SAVED_PLAN)
+        try:
+            if tf.plan(out=plan_file, detailed_exitcode=True):
+                tf.apply(plan_file)
+            else:
+                tf.logger.info('The plan has no changes; skipping apply.')
+        finally:
+            if os.path.exists(plan_file):
+                os.remove(plan_file)
         tf_state = tf.state_pull()
     except Exception as ex:
         _, _, tb = sys.exc_info()
@@ -54,9 +69,14 @@ def _apply(tf):
             "Failed applying",
             causes=[exception_to_error_cause(ex, tb)])
     utils.refresh_resources_properties(tf_state)
+    runtime_properties = utils.get_instance().runtime_properties
+    runtime_properties['terraform_fingerprint'] = _get_fingerprint(tf)
+    runtime_properties['terraform_state_version'] = \
+        utils.get_state_version(tf_state)
 
 
 @operation
+@with_buffered_updates
 @with_terraform
 def state_pull(ctx, tf, **_):
     """
@@ -70,10 +90,25 @@ def state_pull(ctx, tf, **_):
         raise NonRecoverableError(
             "Failed pulling state",
             causes=[exception_to_error_cause(ex, tb)])
+    # The refresh itself always runs, since it is what detects drift.
+    # But if neither the inputs since the last apply nor the refreshed
+    # state changed, the stored resources are already up to date.
+    runtime_properties = ctx.instance.runtime_properties
+    state_version = utils.get_state_version(tf_state)
+    if state_version == runtime_properties.get('terraform_state_version') \
+            and _get_fingerprint(tf) == \
+            runtime_properties.get('terraform_fingerprint'):
+        ctx.logger.info(
+            'Skipping resources update: the inputs did not change and the '
+            'state is still at serial {serial}.'.format(
+                serial=state_version[1]))
+        return
     utils.refresh_resources_properties(tf_state)
+    runtime_properties['terraform_state_version'] = state_version
 
 
 @operation
+@with_buffered_updates
 @with_terraform
 def destroy(ctx, tf, **_):
     """
@@ -82,7 +117,10 @@ def destroy(ctx, tf, **_):
     _destroy(tf)
     ctx.instance.runtime_properties.pop('terraform_source', None)
     ctx.instance.runtime_properties.pop('last_source_location', None)
+    ctx.instance.runtime_properties.pop(utils.SOURCE_VALIDATORS, None)
     ctx.instance.runtime_properties.pop('resource_config', None)
+    ctx.instance.runtime_properties.pop('terraform_fingerprint', None)
+    ctx.instance.runtime_properties.pop('terraform_state_version', None)
 
 
 def _destroy(tf):
@@ -98,6 +136,7 @@ def _destroy(tf):
 
 
 @operation
+@with_buffered_updates
 @with_terraform
 def reload_template(source, destroy_previous, ctx, tf, **_):
     """
@@ -119,6 +158,7 @@ def reload_template(source, destroy_previous, ctx, tf, **_):
 
 
 @operation
+@with_buffered_updates
 @skip_if_existing
 def install(ctx, **_):
 
@@ -139,21 +179,32 @@ def install(ctx, **_):
                         'installation will fail.'.format(
                             loc=executable_path))
         utils.install_binary(
-            installation_dir, executable_path, installation_source)
+            installation_dir,
+            executable_path,
+            installation_source,
+            utils.get_resource_config().get('installation_checksum'))
 
     # store the values in the runtime for safe keeping -> validation
     ctx.instance.runtime_properties['executable_path'] = executable_path
+    utils.invalidate_resolved_config()
     utils.handle_plugins(plugins, plugins_dir, installation_dir)
 
 
 @operation
+@with_buffered_updates
 @skip_if_existing
 def uninstall(ctx, **_):
     terraform_config = utils.get_terraform_config()
     resource_config = utils.get_resource_config()
     exc_path = terraform_config.get('executable_path', '')
     system_exc = resource_config.get('use_existing_resource')
+    shared_exc_path = ctx.instance.runtime_properties.pop(
+        'shared_executable_path', None)
 
+    if shared_exc_path and not system_exc:
+        utils.release_binary(
+            shared_exc_path,
+            ctx.instance.runtime_properties.get('executable_path'))
     if os.path.isfile(exc_path):
         if system_exc:
             ctx.logger.info(
@@ -173,6 +224,7 @@ def uninstall(ctx, **_):
 
 
 @operation
+@with_buffered_updates
 def set_directory_config(ctx, **_):
     exc_path = utils.get_executable_path(target=True)
     plugins_dir = utils.get_plugins_dir(target=True)
@@ -219,3 +271,4 @@ def set_directory_config(ctx, **_):
         resource_plugins_dir
     ctx.source.instance.runtime_properties['storage_path'] = \
         resource_storage_dir
+    utils.invalidate_resolved_config()
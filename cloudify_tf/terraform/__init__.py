@@ -14,13 +14,31 @@
 # limitations under the License.
 
 import os
+import re
 import json
 import tempfile
+import subprocess
 
-from contextlib import contextmanager
+from contextlib import contextmanager, closing
 
 from .. import utils
 
+# The file that plans are saved to, in the root module.
+SAVED_PLAN = 'cloudify.tfplan'
+# The exit code of "plan -detailed-exitcode" when there are changes.
+PLAN_HAS_CHANGES = 2
+# Errors of providers that are throttled by their API.
+RATE_LIMIT_ERRORS = re.compile(
+    r'rate ?limit|throttl|too many requests|\b429\b|slow ?down', re.I)
+# How many host slots each subcommand takes; the others take one.
+COMMAND_WEIGHTS = {
+    'apply': 4,
+    'destroy': 4,
+    'plan': 2,
+    'refresh': 2,
+    'init': 2,
+}
+
 
 class Terraform(object):
     # TODO: Rework this to put the execute method in its own module.
@@ -32,7 +50,13 @@ class Terraform(object):
                  plugins_dir,
                  root_module,
                  variables=None,
-                 environment_variables=None):
+                 environment_variables=None,
+                 json_output=False,
+                 host_slots=None,
+                 parallelism=None,
+                 auto_parallelism=False,
+                 timeout=None,
+                 kill_grace_period=utils.KILL_GRACE_PERIOD):
 
         self.binary_path = binary_path
         self.plugins_dir = self.set_plugins_dir(plugins_dir)
@@ -53,6 +77,22 @@ class Terraform(object):
 
         self.env = environment_variables
         self.variables = variables
+        # Run plan and apply with -json, and log the progress of the
+        # resources rather than every line of the output.
+        self.json_output = json_output
+        # If set, the commands take a weight of the slots of a semaphore
+        # that all the terraform commands on the host share, or, if it is 0,
+        # of the number of slots of the host, see utils.get_host_slots.
+        self.host_slots = host_slots
+        # The -parallelism of plan, apply, destroy and refresh. With
+        # auto_parallelism, it is halved after a command hits rate limits.
+        self.parallelism = parallelism
+        self.auto_parallelism = auto_parallelism
+        self.rate_limit_errors = 0
+        # Commands that do not finish within the timeout are interrupted,
+        # and killed if they did not exit within the grace period.
+        self.timeout = timeout
+        self.kill_grace_period = kill_grace_period
 
     @staticmethod
     def set_plugins_dir(path):
@@ -60,16 +100,66 @@ class Terraform(object):
             return
         return path
 
-    def execute(self, command, return_output=False):
-        return utils.run_subprocess(
-            command, self.logger, self.root_module,
-            self.env, return_output=return_output)
+    def _command_weight(self, command):
+        return COMMAND_WEIGHTS.get(command[1], 1) if len(command) > 1 else 1
+
+    @contextmanager
+    def _host_slots(self, command):
+        if self.host_slots is None:
+            yield
+            return
+        with utils.host_slots(self._command_weight(command),
+                              self.host_slots,
+                              self.logger):
+            yield
+
+    def _check_rate_limits(self, line):
+        if RATE_LIMIT_ERRORS.search(line):
+            self.rate_limit_errors += 1
+
+    @contextmanager
+    def _parallelism_tuning(self):
+        rate_limit_errors = self.rate_limit_errors
+        try:
+            yield
+        finally:
+            if self.auto_parallelism and self.parallelism and \
+                    self.rate_limit_errors > rate_limit_errors:
+                self.parallelism = max(1, self.parallelism // 2)
+                self.logger.warning(
+                    'The command hit rate limits; lowering the parallelism '
+                    'to {parallelism}.'.format(parallelism=self.parallelism))
+
+    def execute(self, command, return_output=False, stdout_parser=None):
+        with self._host_slots(command), self._parallelism_tuning():
+            return utils.run_subprocess(
+                command, self.logger, self.root_module,
+                self.env, return_output=return_output,
+                stdout_parser=stdout_parser,
+                stderr_handler=self._check_rate_limits,
+                timeout=self.timeout,
+                kill_grace_period=self.kill_grace_period)
+
+    def _events_parser(self):
+        # With -json, the diagnostics are events on stdout, not on stderr.
+        return utils.TerraformEventsParser(self.logger,
+                                           self._check_rate_limits)
+
+    def _execute_with_events(self, command):
+        if not self.json_output:
+            return self.execute(command)
+        return self.execute(command, stdout_parser=self._events_parser())
 
     def _tf_command(self, args):
         cmd = [self.binary_path]
         cmd.extend(args)
         return cmd
 
+    def _parallelism_args(self):
+        if self.parallelism:
+            return ['-parallelism=%d' % self.parallelism]
+        return []
+
     @contextmanager
     def _vars_file(self, command):
         with tempfile.NamedTemporaryFile(suffix=".json",
@@ -97,20 +187,49 @@ class Terraform(object):
 
     def destroy(self):
         command = self._tf_command(['destroy', '-auto-approve', '-no-color',
-                                    '-input=false'])
+                                    '-input=false'] +
+                                   self._parallelism_args())
         with self._vars_file(command):
             return self.execute(command)
 
-    def plan(self):
-        command = self._tf_command(['plan', '-no-color', '-input=false'])
+    def plan(self, out=None, detailed_exitcode=False):
+        """Execute "terraform plan", optionally saving the plan to out.
+        With detailed_exitcode, returns whether the plan has any changes.
+        """
+        cmdline = ['plan', '-no-color', '-input=false']
+        cmdline.extend(self._parallelism_args())
+        if self.json_output:
+            cmdline.append('-json')
+        if out:
+            cmdline.append('-out=%s' % out)
+        if detailed_exitcode:
+            cmdline.append('-detailed-exitcode')
+        command = self._tf_command(cmdline)
         with self._vars_file(command):
-            return self.execute(command)
+            if not detailed_exitcode:
+                return self._execute_with_events(command)
+            try:
+                self._execute_with_events(command)
+            except subprocess.CalledProcessError as e:
+                if e.returncode == PLAN_HAS_CHANGES:
+                    return True
+                raise
+            return False
 
-    def apply(self):
-        command = self._tf_command(['apply', '-auto-approve', '-no-color',
-                                    '-input=false'])
+    def apply(self, plan_file=None):
+        """Execute "terraform apply", of a saved plan if plan_file is given.
+        A saved plan already contains the variables.
+        """
+        cmdline = ['apply', '-auto-approve', '-no-color', '-input=false']
+        cmdline.extend(self._parallelism_args())
+        if self.json_output:
+            cmdline.append('-json')
+        command = self._tf_command(cmdline)
+        if plan_file:
+            command.append(plan_file)
+            return self._execute_with_events(command)
         with self._vars_file(command):
-            return self.execute(command)
+            return self._execute_with_events(command)
 
     def graph(self):
         command = self._tf_command(['graph'])
@@ -118,15 +237,14 @@ class Terraform(object):
 
     def state_pull(self):
         command = self._tf_command(['state', 'pull'])
-        pulled_state = self.execute(command, True)
-        # If we got here, then the "state pull" return code must
-        # be zero, and pulled_state actually contains a parse-able
-        # JSON.
-        if pulled_state:
-            return json.loads(pulled_state)
+        # The state can be large: it is parsed from the captured output,
+        # which is spilled to disk past a size, rather than logged.
+        with closing(self.execute(command, utils.STREAM_OUTPUT)) as output:
+            return utils.parse_json_output(output)
 
     def refresh(self):
-        command = self._tf_command(['refresh', '-no-color'])
+        command = self._tf_command(['refresh', '-no-color'] +
+                                   self._parallelism_args())
         with self._vars_file(command):
             return self.execute(command)
 
@@ -139,11 +257,18 @@ class Terraform(object):
         if not os.path.exists(plugins_dir) and utils.is_using_existing():
             utils.mkdir_p(plugins_dir)
         env_variables = resource_config.get('environment_variables')
+        parallelism = utils.parse_parallelism(
+            resource_config.get('parallelism'))
         tf = Terraform(
                 ctx.logger,
                 executable_path,
                 plugins_dir,
                 terraform_source,
                 variables=resource_config.get('variables'),
-                environment_variables=env_variables)
+                environment_variables=env_variables,
+                json_output=resource_config.get('log_format') == 'json',
+                host_slots=0,
+                parallelism=utils.get_parallelism(parallelism),
+                auto_parallelism=parallelism == 'auto',
+                timeout=resource_config.get('command_timeout') or None)
         return tf
@@ -12,3 +12,35 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+
+import unittest
+
+from cloudify import mocks
+
+from .._compat import PY2
+
+# For the tests that rely on the standard library of Python 3, such as
+# assertLogs and tracemalloc.
+requires_py3 = unittest.skipIf(PY2, 'Requires Python 3.')
+
+
+class MockNodeInstanceContext(mocks.MockNodeInstanceContext):
+    """A node instance that takes a conflict handler on update, as the
+    node instances of operations do.
+    """
+
+    def update(self, on_conflict=None):
+        pass
+
+
+class MockCloudifyContext(mocks.MockCloudifyContext):
+
+    def __init__(self, *args, **kwargs):
+        super(MockCloudifyContext, self).__init__(*args, **kwargs)
+        instance = getattr(self, '_instance', None)
+        if instance is not None:
+            self._instance = MockNodeInstanceContext(
+                id=instance.id,
+                runtime_properties=instance.runtime_properties,
+                relationships=instance.relationships,
+                index=instance.index)
@@ -13,6 +13,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import shutil
 import unittest
 from os import path
 from mock import patch
@@ -20,13 +21,13 @@ from uuid import uuid1
 from tempfile import mkdtemp
 
 from cloudify.state import current_ctx
-from cloudify.mocks import (MockContext, MockCloudifyContext,
-                            MockNodeInstanceContext,
-                            MockNodeContext)
+from cloudify.mocks import MockContext, MockNodeContext
 
 from ..tasks import (install,
+                     uninstall,
                      set_directory_config)
 from ..utils import RELATIONSHIP_INSTANCE
+from . import MockCloudifyContext, MockNodeInstanceContext
 
 
 test_dir1 = mkdtemp()
@@ -58,7 +59,14 @@ class TestPlugin(unittest.TestCase):
         return ctx
 
     @patch('cloudify_tf.utils.get_node_instance_dir', return_value=test_dir1)
-    def test_install(self, _):
+    def test_install(self, *_):
+        cache_dir = mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        patcher = patch('cloudify_tf.utils.get_shared_cache_dir',
+                        return_value=cache_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
         def get_terraform_conf_props():
             return {
                 "terraform_config": {
@@ -96,6 +104,27 @@ class TestPlugin(unittest.TestCase):
             path.isfile(ctx.instance.runtime_properties.get(
                 "executable_path")))
 
+    def test_uninstall(self):
+        work_dir = mkdtemp()
+        self.addCleanup(shutil.rmtree, work_dir)
+        executable_path = path.join(work_dir, "terraform")
+        ctx = self.mock_ctx(
+            "test_uninstall",
+            {"terraform_config": {"executable_path": executable_path},
+             "resource_config": {"use_existing_resource": False}},
+            {"executable_path": executable_path,
+             "shared_executable_path": path.join(work_dir, "cached")})
+        current_ctx.set(ctx=ctx)
+        self.addCleanup(current_ctx.clear)
+        with patch('cloudify_tf.utils.release_binary') as release_binary:
+            uninstall(ctx=ctx)
+            # Uninstalling again does not release the binary twice.
+            uninstall(ctx=ctx)
+        release_binary.assert_called_once_with(
+            path.join(work_dir, "cached"), executable_path)
+        self.assertNotIn("shared_executable_path",
+                         ctx.instance.runtime_properties)
+
     @patch('cloudify_tf.utils.get_node_instance_dir', return_value=test_dir2)
     def test_set_directory_config(self, _):
 
@@ -0,0 +1,513 @@
+########
+# Copyright (c) 2018-2020 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import json
+import stat
+import hashlib
+import shutil
+import logging
+import subprocess
+import threading
+import unittest
+from tempfile import mkdtemp
+from contextlib import contextmanager
+
+from mock import patch
+
+from cloudify.state import current_ctx
+from cloudify.exceptions import NonRecoverableError
+
+from .. import utils
+from ..tasks import _apply, apply, destroy, state_pull
+from ..terraform import Terraform, SAVED_PLAN
+from . import MockCloudifyContext, requires_py3
+
+try:
+    import tracemalloc
+except ImportError:
+    # Python 2.
+    tracemalloc = None
+
+# A stand-in for the terraform binary: it records its arguments, and exits
+# with the code in STUB_<SUBCOMMAND>_EXIT, e.g. STUB_PLAN_EXIT.
+# "state pull" outputs the file at STUB_STATE, if set, and other
+# subcommands the file at STUB_<SUBCOMMAND>_OUTPUT, and the line
+# STUB_<SUBCOMMAND>_ERROR to stderr. With STUB_SLEEP, it sleeps first,
+# until it is interrupted, unless STUB_IGNORE_INT is set. "destroy" leaves
+# an empty terraform.tfstate behind, as terraform does.
+STUB_TERRAFORM = """#!/bin/sh
+if [ -n "$STUB_IGNORE_INT" ]; then
+    trap '' INT
+else
+    trap 'echo interrupted >> "$STUB_LOG"; kill $! 2> /dev/null; exit 130' INT
+fi
+echo "$@" >> "$STUB_LOG"
+if [ -n "$STUB_SLEEP" ]; then
+    sleep "$STUB_SLEEP" > /dev/null 2>&1 &
+    wait $!
+fi
+if [ "$1" = "state" ] && [ -n "$STUB_STATE" ]; then
+    cat "$STUB_STATE"
+elif [ "$1" = "state" ]; then
+    echo '{"version": 4, "resources": []}'
+fi
+if [ "$1" = "destroy" ]; then
+    echo '{"version": 4, "resources": []}' > terraform.tfstate
+fi
+eval "output=\\${STUB_$(echo $1 | tr a-z A-Z)_OUTPUT}"
+if [ -n "$output" ]; then
+    cat "$output"
+fi
+eval "error=\\${STUB_$(echo $1 | tr a-z A-Z)_ERROR}"
+if [ -n "$error" ]; then
+    echo "$error" >&2
+fi
+eval "code=\\${STUB_$(echo $1 | tr a-z A-Z)_EXIT:-0}"
+exit $code
+"""
+
+
+class TestTerraform(unittest.TestCase):
+
+    def setUp(self):
+        super(TestTerraform, self).setUp()
+        self.root_module = mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root_module)
+        self.binary_path = os.path.join(self.root_module, 'terraform')
+        with open(self.binary_path, 'w') as outfile:
+            outfile.write(STUB_TERRAFORM)
+        os.chmod(self.binary_path, stat.S_IRWXU)
+        self.plugins_dir = os.path.join(self.root_module, 'plugins')
+        os.mkdir(self.plugins_dir)
+        log_dir = mkdtemp()
+        self.addCleanup(shutil.rmtree, log_dir)
+        self.log = os.path.join(log_dir, 'stub.log')
+        self.ctx = MockCloudifyContext(node_id='terraform_test',
+                                       deployment_id='terraform_test',
+                                       properties={'resource_config': {}})
+        current_ctx.set(ctx=self.ctx)
+        self.addCleanup(current_ctx.clear)
+        patcher = patch('cloudify_tf.utils.get_node_instance_dir',
+                        return_value=self.root_module)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def terraform(self, json_output=False, **environment_variables):
+        environment_variables['STUB_LOG'] = self.log
+        return Terraform(logging.getLogger('test_terraform'),
+                         self.binary_path,
+                         self.plugins_dir,
+                         self.root_module,
+                         variables={'a': 'b'},
+                         environment_variables=environment_variables,
+                         json_output=json_output)
+
+    def commands(self):
+        with open(self.log) as infile:
+            return [line.split() for line in infile.read().splitlines()]
+
+    def test_apply_saved_plan(self):
+        _apply(self.terraform(STUB_PLAN_EXIT='2'))
+        plan_file = os.path.join(self.root_module, SAVED_PLAN)
+        init, plan, apply, state_pull = self.commands()
+        self.assertIn('-out=%s' % plan_file, plan)
+        self.assertIn('-detailed-exitcode', plan)
+        # The saved plan is applied as is, without planning again.
+        self.assertEqual(apply[-1], plan_file)
+        self.assertNotIn('-var-file', apply)
+        self.assertEqual(state_pull, ['state', 'pull'])
+        self.assertFalse(os.path.exists(plan_file))
+
+    def test_apply_no_changes(self):
+        _apply(self.terraform(STUB_PLAN_EXIT='0'))
+        self.assertEqual([command[0] for command in self.commands()],
+                         ['init', 'plan', 'state'])
+
+    def test_plan_failure(self):
+        tf = self.terraform(STUB_PLAN_EXIT='1')
+        with self.assertRaises(NonRecoverableError):
+            _apply(tf)
+        self.assertEqual([command[0] for command in self.commands()],
+                         ['init', 'plan'])
+
+    def run_operation(self, operation, tf):
+        @contextmanager
+        def terraform_source():
+            yield self.root_module
+
+        with patch('cloudify_tf.decorators.get_terraform_source',
+                   side_effect=terraform_source), \
+                patch('cloudify_tf.decorators.Terraform.from_ctx',
+                      return_value=tf):
+            operation(ctx=self.ctx)
+
+    def test_apply_unchanged(self):
+        with open(os.path.join(self.root_module, 'main.tf'), 'w') as f:
+            f.write('resource "a" "b" {}')
+        self.run_operation(apply, self.terraform(STUB_PLAN_EXIT='2'))
+        self.assertEqual([command[0] for command in self.commands()],
+                         ['init', 'plan', 'apply', 'state'])
+
+        # Nothing changed: the plan has no changes, so it is not applied.
+        self.run_operation(apply, self.terraform(STUB_PLAN_EXIT='0'))
+        self.assertEqual([command[0] for command in self.commands()[4:]],
+                         ['init', 'plan', 'state'])
+
+        # The inputs did not change either, but the plan found drift.
+        self.run_operation(apply, self.terraform(STUB_PLAN_EXIT='2'))
+        self.assertEqual([command[0] for command in self.commands()[7:]],
+                         ['init', 'plan', 'apply', 'state'])
+
+    def test_state_pull_unchanged(self):
+        self.run_operation(apply, self.terraform(STUB_PLAN_EXIT='2'))
+        self.ctx.instance.runtime_properties['resources'] = {'stale': {}}
+
+        # The state did not change, so the resources are left alone.
+        self.run_operation(state_pull, self.terraform(STUB_PLAN_EXIT='2'))
+        self.assertEqual([command[0] for command in self.commands()[-2:]],
+                         ['refresh', 'state'])
+        self.assertEqual(self.ctx.instance.runtime_properties['resources'],
+                         {'stale': {}})
+
+        # Inputs changed since the last apply.
+        self.run_operation(state_pull, self.terraform(NEW_VARIABLE='1'))
+        self.assertEqual(self.ctx.instance.runtime_properties['resources'],
+                         {})
+
+        # The resource config changed since the last apply.
+        self.run_operation(apply, self.terraform(STUB_PLAN_EXIT='0'))
+        self.ctx.instance.runtime_properties['resources'] = {'stale': {}}
+        self.ctx.node.properties['resource_config']['resources_index'] = {
+            'compact': True}
+        utils.invalidate_resolved_config()
+        self.run_operation(state_pull, self.terraform(STUB_PLAN_EXIT='0'))
+        self.assertEqual(self.ctx.instance.runtime_properties['resources'],
+                         {})
+
+    def test_destroy(self):
+        source_dir = mkdtemp()
+        self.addCleanup(shutil.rmtree, source_dir)
+        with open(os.path.join(source_dir, 'main.tf'), 'w') as outfile:
+            outfile.write('resource "a" "b" {}')
+        archive = utils._zip_archive(source_dir)
+        self.addCleanup(os.remove, archive)
+        runtime_properties = self.ctx.instance.runtime_properties
+        runtime_properties['terraform_source'] = \
+            utils._file_to_base64(archive)
+
+        # destroy changes the state, after the source is removed.
+        with patch('cloudify_tf.decorators.Terraform.from_ctx',
+                   return_value=self.terraform()):
+            destroy(ctx=self.ctx)
+        self.assertEqual([command[0] for command in self.commands()],
+                         ['init', 'plan', 'destroy'])
+        self.assertNotIn('terraform_source', runtime_properties)
+
+    def test_one_instance_update(self):
+        self.run_operation(apply, self.terraform(STUB_PLAN_EXIT='2'))
+        self.assertEqual(utils.get_instance_update_count(), 1)
+        self.assertIn('terraform_fingerprint',
+                      self.ctx.instance.runtime_properties)
+
+    @requires_py3
+    def test_state_pull_large(self):
+        state = {'version': 4, 'resources': [
+            {'mode': 'managed', 'type': 'aws_instance',
+             'name': 'web_{0}'.format(i),
+             'instances': [{'attributes': {'id': 'x' * 1000}}]}
+            for i in range(5000)]}
+        state_file = os.path.join(os.path.dirname(self.log), 'state.json')
+        with open(state_file, 'w') as outfile:
+            json.dump(state, outfile)
+        tf = self.terraform(STUB_STATE=state_file)
+
+        def peak_memory(pull):
+            tracemalloc.start()
+            try:
+                with self.assertLogs('test_terraform') as logs:
+                    self.assertEqual(pull(), state)
+                return tracemalloc.get_traced_memory()[1], logs.output
+            finally:
+                tracemalloc.stop()
+
+        def parse_file():
+            with open(state_file, 'rb') as infile:
+                logging.getLogger('test_terraform').info('Parsing.')
+                return utils.parse_json_output(infile)
+
+        peak, logs = peak_memory(tf.state_pull)
+        parse_file_peak, _ = peak_memory(parse_file)
+        # The state is not logged, only its size and digest.
+        self.assertLess(sum(len(line) for line in logs), 10000)
+        with open(state_file, 'rb') as infile:
+            self.assertIn(hashlib.sha256(infile.read()).hexdigest(),
+                          logs[-1])
+        # Pulling the state takes about as much memory as parsing it from
+        # a file: the captured output is spilled to disk.
+        self.assertLess(peak, parse_file_peak + 2 * utils.OUTPUT_SPOOL_SIZE)
+
+    @requires_py3
+    def test_json_output(self):
+        events = [{'type': 'version', '@message': 'Terraform 1.0.0'}]
+        for i in range(20):
+            resource = {
+                'resource': {'addr': 'aws_instance.web[{0}]'.format(i)}}
+            events.append({'type': 'apply_start', 'hook': resource,
+                           '@message': 'Creating...'})
+            events.extend({'type': 'apply_progress', 'hook': resource,
+                           '@message': 'Still creating...'}
+                          for _ in range(10))
+            events.append({'type': 'apply_complete',
+                           'hook': dict(resource, elapsed_seconds=i),
+                           '@message': 'Creation complete'})
+        events.append({'type': 'change_summary',
+                       '@message': 'Apply complete! Resources: 20 added.'})
+        events_file = os.path.join(os.path.dirname(self.log), 'events')
+        with open(events_file, 'w') as outfile:
+            outfile.write('\n'.join(json.dumps(event) for event in events))
+
+        tf = self.terraform(json_output=True, STUB_APPLY_OUTPUT=events_file)
+        # The run took 30s, from its first event to its last, while the
+        # resources took 190s altogether.
+        event_times = [i * 30.0 / (len(events) - 1)
+                       for i in range(len(events))]
+        with self.assertLogs('test_terraform') as logs, \
+                patch.object(utils.TerraformEventsParser, 'clock',
+                             side_effect=event_times):
+            timings = tf.apply('plan')
+        apply = self.commands()[0]
+        self.assertEqual(apply[-2:], ['-json', 'plan'])
+        self.assertEqual(len(timings), 20)
+        self.assertEqual(timings['aws_instance.web[3]'], 3)
+        messages = [record.getMessage() for record in logs.records
+                    if record.levelno >= logging.INFO and not
+                    record.getMessage().startswith(('Running:', 'Parsed'))]
+        self.assertEqual(messages, [
+            'Applied 10 of 10 started resources.',
+            'Applied 20 of 20 started resources.',
+            'Apply complete! Resources: 20 added.',
+            'Applied 20 resources in 30.0s; the slowest: '
+            'aws_instance.web[19] (19s), aws_instance.web[18] (18s), '
+            'aws_instance.web[17] (17s), aws_instance.web[16] (16s), '
+            'aws_instance.web[15] (15s).'])
+
+    def test_timeout(self):
+        # The stub exits as soon as it is interrupted.
+        tf = self.terraform(STUB_SLEEP='30')
+        tf.timeout = 0.5
+        tf.kill_grace_period = 30
+        with patch.object(subprocess.Popen, 'kill',
+                          autospec=True) as kill, \
+                self.assertRaises(NonRecoverableError):
+            tf.refresh()
+        self.assertFalse(kill.called)
+        self.assertEqual(self.commands()[-1], ['interrupted'])
+
+        # The stub ignores the interrupt, so it is killed after the grace
+        # period.
+        tf = self.terraform(STUB_SLEEP='30', STUB_IGNORE_INT='1')
+        tf.timeout = 0.5
+        tf.kill_grace_period = 0.5
+        with patch.object(subprocess.Popen, 'kill', autospec=True,
+                          side_effect=subprocess.Popen.kill) as kill, \
+                self.assertRaises(NonRecoverableError):
+            tf.refresh()
+        self.assertEqual(kill.call_count, 1)
+        self.assertEqual(self.commands()[-1][0], 'refresh')
+
+    @contextmanager
+    def host_slots_waiters(self, count):
+        """Yield an event per waiter for host slots, that is set once that
+        many waiters queued up.
+        """
+        queued = [threading.Event() for _ in range(count)]
+        enqueue = utils._enqueue_host_slots_waiter
+        lock = threading.Lock()
+
+        def enqueue_and_notify(*args):
+            waiter = enqueue(*args)
+            with lock:
+                next(event for event in queued if not event.is_set()).set()
+            return waiter
+
+        with patch('cloudify_tf.utils._enqueue_host_slots_waiter',
+                   side_effect=enqueue_and_notify):
+            yield queued
+
+    def run_with_host_slots(self, run_command, *commands):
+        """Run each command in a thread of its own, with run_command in
+        place of utils.run_subprocess. Returns the messages about the time
+        waited for host slots.
+        """
+        cache_dir = mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        tf = self.terraform()
+        tf.host_slots = 4
+        errors = []
+
+        def run(command):
+            try:
+                command(tf)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=run, args=(command,))
+                   for command in commands]
+        with patch('cloudify_tf.utils.get_shared_cache_dir',
+                   return_value=cache_dir), \
+                patch('cloudify_tf.utils.run_subprocess',
+                      side_effect=run_command), \
+                self.assertLogs('test_terraform') as logs:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(errors, [])
+        return [record.getMessage() for record in logs.records
+                if record.getMessage().startswith('Waited')]
+
+    @requires_py3
+    def test_host_slots(self):
+        # Each apply takes all the slots, so they run one after the other:
+        # the second one only starts once the first one ended.
+        running = []
+        events = []
+
+        with self.host_slots_waiters(2) as queued:
+            def apply_command(command, *_, **__):
+                running.append(command)
+                events.append(('start', len(running)))
+                # Let the other apply queue up while this one runs.
+                self.assertTrue(queued[1].wait(30))
+                running.remove(command)
+                events.append(('end', len(running)))
+
+            waits = self.run_with_host_slots(
+                apply_command,
+                lambda tf: tf.apply('plan'), lambda tf: tf.apply('plan'))
+        self.assertEqual(events, [('start', 1), ('end', 0)] * 2)
+        self.assertEqual(
+            sorted(wait.split(' ', 2)[2] for wait in waits),
+            ['for 4 of 4 host slots.'] * 2)
+
+        # While versions only take one slot each, so they all run at once.
+        all_running = threading.Barrier(4, timeout=30)
+        waits = self.run_with_host_slots(
+            lambda *_, **__: all_running.wait(),
+            *[lambda tf: tf.version()] * 4)
+        self.assertEqual(len(waits), 4)
+
+    def test_host_slots_fairness(self):
+        slots_dir = mkdtemp()
+        self.addCleanup(shutil.rmtree, slots_dir)
+        queue_dir = os.path.join(slots_dir, 'queue')
+        acquired = []
+
+        def acquire(name, weight):
+            held_slots = utils.acquire_host_slots(weight, 4, slots_dir)
+            acquired.append(name)
+            utils.release_host_slots(held_slots)
+
+        held_slots = utils.acquire_host_slots(1, 4, slots_dir)
+        with self.host_slots_waiters(2) as queued:
+            heavy = threading.Thread(target=acquire, args=('heavy', 4))
+            heavy.start()
+            self.assertTrue(queued[0].wait(30))
+            # The light command could take one of the free slots, but it
+            # waits for the heavy one that asked for slots before it.
+            light = threading.Thread(target=acquire, args=('light', 1))
+            light.start()
+            self.assertTrue(queued[1].wait(30))
+        self.assertEqual(len(os.listdir(queue_dir)), 2)
+        self.assertEqual(acquired, [])
+        utils.release_host_slots(held_slots)
+        heavy.join()
+        light.join()
+        self.assertEqual(acquired, ['heavy', 'light'])
+        self.assertEqual(os.listdir(queue_dir), [])
+
+        # The entry of a waiter that died does not hold back the others.
+        open(os.path.join(queue_dir, '0' * 20), 'w').close()
+        utils.release_host_slots(utils.acquire_host_slots(1, 4, slots_dir))
+        self.assertEqual(os.listdir(queue_dir), [])
+
+        with patch.dict(os.environ, {utils.HOST_SLOTS_ENV: '6'}):
+            self.assertEqual(utils.get_host_slots(), 6)
+
+    def test_parallelism(self):
+        tf = self.terraform(
+            STUB_APPLY_ERROR='Error: Throttling: Rate exceeded')
+        tf.parallelism = 8
+        tf.plan('plan')
+        tf.refresh()
+        tf.destroy()
+        for command in self.commands():
+            self.assertIn('-parallelism=8', command)
+
+        # The apply hits rate limits, so the next commands run with less.
+        tf.auto_parallelism = True
+        tf.apply('plan')
+        tf.plan('plan')
+        self.assertEqual(self.commands()[-2][0], 'apply')
+        self.assertIn('-parallelism=8', self.commands()[-2])
+        self.assertIn('-parallelism=4', self.commands()[-1])
+        self.assertEqual(tf.rate_limit_errors, 1)
+
+        utils.record_parallelism(tf)
+        self.assertEqual(
+            self.ctx.instance.runtime_properties[utils.PARALLELISM],
+            {'value': 4, 'rate_limited': True})
+        # It is not raised after a run that hit rate limits.
+        self.ctx.instance.runtime_properties['resources'] = dict(
+            ('resource_{0}'.format(i), {})
+            for i in range(utils.LARGE_MODULE_RESOURCES))
+        with patch('cloudify_tf.utils._get_host_load', return_value=0):
+            self.assertEqual(utils.get_parallelism('auto'), 4)
+            self.ctx.instance.runtime_properties[utils.PARALLELISM][
+                'rate_limited'] = False
+            self.assertEqual(utils.get_parallelism('auto'), 8)
+        # Nor while the host is busy.
+        with patch('cloudify_tf.utils._get_host_load', return_value=1):
+            self.assertEqual(utils.get_parallelism('auto'), 4)
+        self.assertEqual(utils.get_parallelism(16), 16)
+        self.assertIsNone(utils.get_parallelism())
+
+    def test_parse_parallelism(self):
+        self.assertEqual(utils.parse_parallelism('5'), 5)
+        self.assertEqual(utils.parse_parallelism(5), 5)
+        self.assertEqual(utils.parse_parallelism(' Auto '), 'auto')
+        self.assertIsNone(utils.parse_parallelism(None))
+        for invalid in ['five', '2.5', 0, -1, True]:
+            with self.assertRaises(NonRecoverableError):
+                utils.parse_parallelism(invalid)
+
+    def test_parallelism_json_output(self):
+        # With -json, the rate limit errors are diagnostics on stdout.
+        events_file = os.path.join(os.path.dirname(self.log), 'events')
+        with open(events_file, 'w') as outfile:
+            json.dump({'type': 'diagnostic',
+                       '@message': 'Error: creating EC2 Instance',
+                       'diagnostic': {
+                           'severity': 'error',
+                           'detail': 'RequestLimitExceeded: Request limit '
+                                     'exceeded. ThrottlingException.'}},
+                      outfile)
+        tf = self.terraform(json_output=True, STUB_APPLY_OUTPUT=events_file)
+        tf.parallelism = 8
+        tf.auto_parallelism = True
+        tf.apply('plan')
+        self.assertEqual(tf.rate_limit_errors, 1)
+        self.assertEqual(tf.parallelism, 4)
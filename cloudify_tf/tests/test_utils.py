@@ -0,0 +1,992 @@
+########
+# Copyright (c) 2018-2020 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+import logging
+import json
+import stat
+import time
+import base64
+import hashlib
+import shutil
+import zipfile
+import threading
+import unittest
+from uuid import uuid1
+from tempfile import mkdtemp
+from contextlib import contextmanager
+
+import requests
+from mock import Mock, patch
+
+from cloudify.state import current_ctx
+from cloudify.exceptions import NonRecoverableError
+
+from .. import utils
+from .._compat import encodebytes
+from . import MockCloudifyContext, requires_py3
+
+try:
+    import tracemalloc
+    from socketserver import ThreadingMixIn
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    # Python 2.
+    tracemalloc = None
+    from SocketServer import ThreadingMixIn
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+
+def write_files(root_dir, files):
+    for rel_path, content in files.items():
+        file_path = os.path.join(root_dir, rel_path)
+        if not os.path.isdir(os.path.dirname(file_path)):
+            os.makedirs(os.path.dirname(file_path))
+        with open(file_path, 'w') as outfile:
+            outfile.write(content)
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """Serves the server's files, with keep-alive and ranges."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def send_empty(self, code):
+        self.send_response(code)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_HEAD(self):
+        self.server.received.append(
+            (self.command, self.path, self.client_address))
+        if self.server.head_status:
+            return self.send_empty(self.server.head_status)
+        content = self.server.files.get(self.path)
+        if content is None:
+            return self.send_empty(404)
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+
+    def do_GET(self):
+        self.server.received.append(
+            (self.command, self.path, self.client_address))
+        self.server.headers.append(dict(self.headers))
+        content = self.server.files.get(self.path)
+        if content is None:
+            return self.send_empty(404)
+        etag = '"{0}"'.format(hashlib.sha1(content).hexdigest())
+        last_modified = self.server.last_modified.get(self.path)
+        if 'etag' in self.server.validators and \
+                self.headers.get('If-None-Match') == etag:
+            return self.send_empty(304)
+        if last_modified and \
+                self.headers.get('If-Modified-Since') == last_modified:
+            return self.send_empty(304)
+        start = 0
+        range_header = self.headers.get('Range')
+        if range_header:
+            start = int(range_header.split('=')[1].rstrip('-'))
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {0}-{1}/{2}'.format(
+                start, len(content) - 1, len(content)))
+        else:
+            self.send_response(200)
+        body = content[start:]
+        self.send_header('Content-Length', str(len(body)))
+        if 'etag' in self.server.validators:
+            self.send_header('ETag', etag)
+        if last_modified:
+            self.send_header('Last-Modified', last_modified)
+        self.end_headers()
+        if self.path in self.server.truncate:
+            # Drop the connection half way through, once.
+            self.server.truncate.remove(self.path)
+            self.wfile.write(body[:len(body) // 2])
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+    def log_message(self, *_):
+        pass
+
+
+@contextmanager
+def http_stand_in(files, truncate=None, head_status=None, validators=()):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+    server.files = files
+    server.truncate = set(truncate or [])
+    server.head_status = head_status
+    server.validators = set(validators)
+    server.last_modified = {}
+    server.received = []
+    server.headers = []
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        yield server, 'http://127.0.0.1:{0}'.format(server.server_port)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+class TestUtils(unittest.TestCase):
+
+    def setUp(self):
+        super(TestUtils, self).setUp()
+        self.work_dir = mkdtemp()
+        self.addCleanup(shutil.rmtree, self.work_dir)
+
+    def mock_ctx(self, test_name, resource_config=None,
+                 runtime_properties=None):
+        ctx = MockCloudifyContext(
+            node_id=str(uuid1()),
+            properties={'resource_config': resource_config or {}},
+            runtime_properties=runtime_properties,
+            deployment_id=test_name
+        )
+        current_ctx.set(ctx=ctx)
+        self.addCleanup(current_ctx.clear)
+        return ctx
+
+    def make_material(self, files):
+        source_dir = mkdtemp()
+        self.addCleanup(shutil.rmtree, source_dir)
+        write_files(source_dir, files)
+        archive = utils._zip_archive(source_dir)
+        self.addCleanup(os.remove, archive)
+        return utils._file_to_base64(archive)
+
+    def patch_workspace(self):
+        for name, value in [
+                ('get_node_instance_dir', self.work_dir),
+                ('get_executable_path',
+                 os.path.join(self.work_dir, 'terraform')),
+                ('get_plugins_dir',
+                 os.path.join(self.work_dir, '.terraform', 'plugins'))]:
+            patcher = patch('cloudify_tf.utils.' + name, return_value=value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    @contextmanager
+    def workspace(self, material):
+        with contextmanager(utils._yield_terraform_source)(
+                material) as module_root:
+            yield module_root
+
+    def test_workspace_cache(self):
+        ctx = self.mock_ctx('test_workspace_cache',
+                            resource_config={'source_path': ''})
+        material = self.make_material({'main.tf': 'resource "a" "b" {}'})
+        ctx.instance.runtime_properties['terraform_source'] = material
+        self.patch_workspace()
+
+        with patch('cloudify_tf.utils.extract_binary_tf_data',
+                   wraps=utils.extract_binary_tf_data) as extract:
+            with self.workspace(material):
+                pass
+            self.assertEqual(extract.call_count, 1)
+            # Nothing changed, so the material is stored untouched.
+            self.assertEqual(
+                ctx.instance.runtime_properties['terraform_source'],
+                material)
+
+            with self.workspace(material) as module_root:
+                write_files(module_root, {'terraform.tfstate': '{}'})
+            self.assertEqual(extract.call_count, 1)
+            repackaged = ctx.instance.runtime_properties['terraform_source']
+            self.assertNotEqual(repackaged, material)
+
+            # The re-packaged material matches the workspace as well.
+            with self.workspace(repackaged):
+                pass
+            self.assertEqual(extract.call_count, 1)
+
+            # A different material is extracted again.
+            with self.workspace(material):
+                pass
+            self.assertEqual(extract.call_count, 2)
+
+    def test_store_workspace(self):
+        ctx = self.mock_ctx('test_store_workspace',
+                            resource_config={'source_path': ''})
+        material = self.make_material({
+            'main.tf': 'resource "a" "b" {}',
+            'old.tf': ''})
+        runtime_properties = ctx.instance.runtime_properties
+        runtime_properties['terraform_source'] = material
+        self.patch_workspace()
+
+        # Every change packages the whole workspace into the material.
+        with utils.get_terraform_source() as module_root:
+            write_files(module_root, {'terraform.tfstate': '{}'})
+        with utils.get_terraform_source() as module_root:
+            write_files(module_root, {'terraform.tfstate': '{"serial": 1}'})
+            os.remove(os.path.join(module_root, 'old.tf'))
+        self.assertEqual(
+            sorted(runtime_properties),
+            ['resource_config', 'storage_path', 'terraform_source'])
+
+        extracted = mkdtemp()
+        self.addCleanup(shutil.rmtree, extracted)
+        utils.extract_binary_tf_data(
+            extracted, runtime_properties['terraform_source'], '')
+        self.assertEqual(sorted(os.listdir(extracted)),
+                         ['main.tf', 'terraform.tfstate'])
+        with open(os.path.join(extracted, 'terraform.tfstate')) as infile:
+            self.assertEqual(infile.read(), '{"serial": 1}')
+
+    def list_files(self, root_dir):
+        return sorted(rel_path for _, rel_path in utils.walk_files(root_dir))
+
+    def test_unzip_archive_source_path(self):
+        self.mock_ctx('test_unzip_archive_source_path')
+        archive = os.path.join(self.work_dir, 'source.zip')
+        with zipfile.ZipFile(archive, 'w') as zip_ref:
+            zip_ref.writestr('repo-master/README.md', 'readme')
+            zip_ref.writestr('repo-master/tf/main.tf', 'main')
+            zip_ref.writestr('repo-master/tf/modules/vm/main.tf', 'vm')
+            zip_ref.writestr('repo-master/mytf/other.tf', 'other')
+        target = os.path.join(self.work_dir, 'target')
+
+        utils._unzip_archive(archive, target, 'tf')
+        self.assertEqual(self.list_files(target),
+                         ['main.tf', os.path.join('modules', 'vm', 'main.tf')])
+
+        # A directory of the same name at another depth does not match.
+        archive = os.path.join(self.work_dir, 'nested.zip')
+        with zipfile.ZipFile(archive, 'w') as zip_ref:
+            zip_ref.writestr('modules/x/main.tf', 'x')
+            zip_ref.writestr('a/modules/x/other.tf', 'other')
+            zip_ref.writestr('b/modules/xy/other.tf', 'other')
+        target = os.path.join(self.work_dir, 'nested')
+        utils._unzip_archive(archive, target, 'modules/x')
+        self.assertEqual(self.list_files(target), ['main.tf'])
+
+    def test_unzip_workspace_package(self):
+        self.mock_ctx('test_unzip_workspace_package')
+        files = {'main.tf': 'main',
+                 'terraform.tfstate': '{}',
+                 os.path.join('templates', 'tf', 'user_data.tpl'): 'data'}
+        write_files(self.work_dir, files)
+        archive = utils._zip_archive(self.work_dir, workspace=True)
+        self.addCleanup(os.remove, archive)
+        target = os.path.join(self.work_dir, 'target')
+
+        # source_path only applies to raw sources, so the whole workspace
+        # is extracted, even though templates/tf/ matches it.
+        utils._unzip_archive(archive, target, 'tf')
+        self.assertEqual(self.list_files(target), sorted(files))
+
+    def test_unzip_archive_single_pass(self):
+        self.mock_ctx('test_unzip_archive_single_pass')
+        archive = os.path.join(self.work_dir, 'large.zip')
+        entries = [os.path.join('modules', 'm{0}'.format(i % 30),
+                                'r{0}.tf'.format(i)) for i in range(3000)]
+        with zipfile.ZipFile(archive, 'w') as zip_ref:
+            for rel_path in entries:
+                zip_ref.writestr(rel_path, rel_path)
+        target = os.path.join(self.work_dir, 'target')
+
+        with patch('zipfile.ZipFile.open',
+                   autospec=True,
+                   side_effect=zipfile.ZipFile.open) as open_entry, \
+                patch('zipfile.ZipFile.extractall') as extractall:
+            utils._unzip_archive(archive, target, '')
+        # Every entry is read exactly once, and never the whole archive.
+        self.assertEqual(open_entry.call_count, len(entries))
+        extractall.assert_not_called()
+        self.assertEqual(self.list_files(target), sorted(entries))
+        with open(os.path.join(target, entries[-1])) as infile:
+            self.assertEqual(infile.read(), entries[-1])
+
+    def test_zip_archive_exclusions(self):
+        self.mock_ctx('test_zip_archive_exclusions')
+        write_files(self.work_dir, {
+            'main.tf': '',
+            'terraform': '',
+            'cloudify.tfplan': '',
+            os.path.join('modules', 'vm', 'main.tf'): '',
+            os.path.join('modules', 'vm', 'vm.tfplan'): '',
+            os.path.join('.terraform', 'modules', 'modules.json'): '',
+        })
+        plugins_dir = os.path.join(self.work_dir, '.terraform', 'plugins')
+        providers = 200
+        for i in range(providers):
+            write_files(plugins_dir, {
+                os.path.join('registry.terraform.io', 'p{0}'.format(i),
+                             'linux_amd64', 'provider'): ''})
+
+        visited = []
+
+        def walk(top):
+            for dir_name, subdirs, filenames in os_walk(top):
+                visited.append(dir_name)
+                yield dir_name, subdirs, filenames
+
+        os_walk = os.walk
+        with patch('os.walk', side_effect=walk):
+            archive = utils._zip_archive(
+                self.work_dir,
+                exclude_files=[os.path.join(self.work_dir, 'terraform'),
+                               plugins_dir,
+                               '*.tfplan'])
+        self.addCleanup(os.remove, archive)
+
+        with zipfile.ZipFile(archive, 'r') as zip_ref:
+            self.assertEqual(sorted(zip_ref.namelist()),
+                             ['.terraform/modules/modules.json',
+                              'main.tf',
+                              'modules/vm/main.tf'])
+        # The plugins directory is pruned, not walked and filtered.
+        self.assertFalse([d for d in visited if d.startswith(plugins_dir)])
+
+    def test_exclusion_patterns(self):
+        exclusions = utils.compile_exclusions(
+            self.work_dir, ['.terraform/**', '*.tfplan', 'modules/*/x.tf'])
+        self.assertTrue(utils.is_excluded('.terraform', exclusions))
+        self.assertTrue(utils.is_excluded('plan.tfplan', exclusions))
+        self.assertTrue(utils.is_excluded(
+            os.path.join('a', 'plan.tfplan'), exclusions))
+        self.assertTrue(utils.is_excluded(
+            os.path.join('modules', 'vm', 'x.tf'), exclusions))
+        self.assertFalse(utils.is_excluded('x.tf', exclusions))
+        self.assertFalse(utils.is_excluded('main.tf', exclusions))
+
+    def test_base64_round_trip(self):
+        source = os.path.join(self.work_dir, 'source.bin')
+        with open(source, 'wb') as outfile:
+            outfile.write(os.urandom(utils.BASE64_CHUNK_SIZE * 3 + 17))
+        with open(source, 'rb') as infile:
+            content = infile.read()
+
+        data = utils._file_to_base64(source)
+        # The stored format is unchanged.
+        self.assertEqual(data, encodebytes(content).decode('utf-8'))
+        target = os.path.join(self.work_dir, 'target.bin')
+        with open(target, 'wb') as outfile:
+            utils._base64_to_file(data, outfile)
+        with open(target, 'rb') as infile:
+            self.assertEqual(infile.read(), content)
+
+    @requires_py3
+    def test_base64_decode_memory(self):
+        peaks = []
+        for size in (1, 16):
+            data = base64.b64encode(
+                os.urandom(size * 1024 * 1024)).decode('utf-8')
+            with open(os.devnull, 'wb') as outfile:
+                tracemalloc.start()
+                utils._base64_to_file(data, outfile)
+                _, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+            peaks.append(peak)
+        # The peak memory does not grow with the size of the data.
+        self.assertLess(peaks[1], 1024 * 1024)
+        self.assertLess(peaks[1], peaks[0] * 2)
+
+    def test_install_binary_shared(self):
+        ctx = self.mock_ctx('test_install_binary_shared')
+        self.patch_workspace()
+        cache_dir = mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        downloads = []
+
+        def download_file(destination, source, checksum=None):
+            downloads.append(source)
+            # Give the other installations a chance to race this one.
+            time.sleep(0.2)
+            with zipfile.ZipFile(destination, 'w') as zip_ref:
+                zip_ref.writestr('terraform', '#!/bin/sh\n')
+
+        def install(executable_path):
+            current_ctx.set(ctx=ctx)
+            utils.install_binary(self.work_dir, executable_path, source)
+
+        source = 'https://releases.hashicorp.com/terraform/0.13.3/' \
+                 'terraform_0.13.3_linux_amd64.zip'
+        executable_paths = [
+            os.path.join(self.work_dir, 'instance_{0}'.format(i), 'terraform')
+            for i in range(5)]
+        with patch('cloudify_tf.utils.get_shared_cache_dir',
+                   return_value=cache_dir), \
+                patch('cloudify_tf.utils.download_file',
+                      side_effect=download_file):
+            threads = [threading.Thread(target=install, args=(path,))
+                       for path in executable_paths]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(downloads, [source])
+        for executable_path in executable_paths:
+            self.assertTrue(os.access(executable_path, os.X_OK))
+        cached_binary = ctx.instance.runtime_properties[
+            'shared_executable_path']
+        self.assertTrue(cached_binary.startswith(cache_dir))
+
+        # The cached binary stays as long as an installation refers to it.
+        for executable_path in executable_paths[:-1]:
+            utils.release_binary(cached_binary, executable_path)
+            self.assertFalse(os.path.exists(executable_path))
+        self.assertTrue(os.path.isfile(cached_binary))
+        utils.release_binary(cached_binary, executable_paths[-1])
+        self.assertFalse(os.path.exists(os.path.dirname(cached_binary)))
+
+        # Installing it again creates the cache entry anew.
+        with patch('cloudify_tf.utils.get_shared_cache_dir',
+                   return_value=cache_dir), \
+                patch('cloudify_tf.utils.download_file',
+                      side_effect=download_file):
+            install(executable_paths[0])
+            self.assertEqual(downloads, [source, source])
+            self.assertTrue(os.access(executable_paths[0], os.X_OK))
+
+            # The binary downloaded without a checksum is not used for an
+            # installation that requires one.
+            utils.install_binary(self.work_dir, executable_paths[1], source,
+                                 '0' * 64)
+        self.assertEqual(downloads, [source] * 3)
+        self.assertNotEqual(
+            ctx.instance.runtime_properties['shared_executable_path'],
+            cached_binary)
+
+    def test_handle_plugins_mirror(self):
+        self.mock_ctx('test_handle_plugins_mirror')
+        self.patch_workspace()
+        cache_dir = mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        downloads = []
+        active = []
+        concurrent = []
+
+        def download_file(destination, source, checksum=None):
+            downloads.append((source, checksum))
+            active.append(source)
+            concurrent.append(len(active))
+            time.sleep(0.2)
+            with zipfile.ZipFile(destination, 'w') as zip_ref:
+                zip_ref.writestr('terraform-provider-' + source[-1], source)
+            active.remove(source)
+
+        plugins = dict(
+            ('registry.terraform.io/hashicorp/p{0}'.format(i),
+             'https://example.com/provider{0}'.format(i))
+            for i in range(4))
+        plugins['registry.terraform.io/hashicorp/checked'] = {
+            'url': 'https://example.com/provider9',
+            'checksum': '0' * 64,
+        }
+        plugins_dir = os.path.join(self.work_dir, '.terraform', 'plugins')
+        with patch('cloudify_tf.utils.get_shared_cache_dir',
+                   return_value=cache_dir), \
+                patch('cloudify_tf.utils.download_file',
+                      side_effect=download_file):
+            utils.handle_plugins(plugins, plugins_dir, self.work_dir)
+            # Another deployment uses the mirror.
+            other_plugins_dir = os.path.join(self.work_dir, 'other')
+            utils.handle_plugins(plugins, other_plugins_dir, self.work_dir)
+
+        self.assertEqual(sorted(downloads), sorted(
+            [('https://example.com/provider{0}'.format(i), None)
+             for i in range(4)] +
+            [('https://example.com/provider9', '0' * 64)]))
+        self.assertGreater(max(concurrent), 1)
+        for plugins_root in (plugins_dir, other_plugins_dir):
+            for i in range(4):
+                self.assertTrue(os.path.isfile(os.path.join(
+                    plugins_root, 'registry.terraform.io', 'hashicorp',
+                    'p{0}'.format(i), 'terraform-provider-{0}'.format(i))))
+
+    def test_handle_plugins_mirror_failure(self):
+        self.mock_ctx('test_handle_plugins_mirror_failure')
+        self.patch_workspace()
+        cache_dir = mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        plugins_dir = os.path.join(self.work_dir, '.terraform', 'plugins')
+        installation_dir = os.path.join(self.work_dir, 'installation')
+        os.mkdir(installation_dir)
+
+        def download_failure(destination, source, checksum=None):
+            raise NonRecoverableError('Failed to download.')
+
+        def download_corrupt(destination, source, checksum=None):
+            with open(destination, 'wb') as outfile:
+                outfile.write(b'not a zip')
+
+        for download_file in (download_failure, download_corrupt):
+            with patch('cloudify_tf.utils.get_shared_cache_dir',
+                       return_value=cache_dir), \
+                    patch('cloudify_tf.utils.download_file',
+                          side_effect=download_file):
+                with self.assertRaises(Exception):
+                    utils.handle_plugins(
+                        {'registry.terraform.io/hashicorp/p':
+                         'https://example.com/provider'},
+                        plugins_dir, installation_dir)
+            # Neither the download nor the extraction is left behind.
+            self.assertEqual(os.listdir(installation_dir), [])
+            self.assertEqual(
+                [name for name in os.listdir(
+                    os.path.join(cache_dir, 'plugins'))
+                 if not name.endswith('.lock')],
+                [])
+
+    def test_unzip_and_set_permissions(self):
+        self.mock_ctx('test_unzip_and_set_permissions')
+        archive = os.path.join(self.work_dir, 'provider.zip')
+        with zipfile.ZipFile(archive, 'w') as zip_ref:
+            for i in range(200):
+                zip_ref.writestr('bin/provider{0}'.format(i), '')
+            info = zipfile.ZipInfo('bin/readonly')
+            info.external_attr = (stat.S_IFREG | 0o444) << 16
+            zip_ref.writestr(info, '')
+        target = os.path.join(self.work_dir, 'target')
+
+        with patch('subprocess.Popen') as popen:
+            utils.unzip_and_set_permissions(archive, target)
+        # The permissions are set in-process.
+        popen.assert_not_called()
+        self.assertTrue(os.access(os.path.join(target, 'bin', 'provider0'),
+                                  os.X_OK))
+        self.assertEqual(
+            stat.S_IMODE(os.stat(os.path.join(
+                target, 'bin', 'readonly')).st_mode),
+            0o544)
+
+    def test_download_file_resume(self):
+        self.mock_ctx('test_download_file_resume')
+        content = os.urandom(3 * 1024 * 1024)
+        destination = os.path.join(self.work_dir, 'provider.zip')
+        with http_stand_in({'/provider.zip': content},
+                           truncate=['/provider.zip']) as (server, url), \
+                patch('cloudify_tf.utils.time.sleep'):
+            utils.download_file(destination, url + '/provider.zip')
+        with open(destination, 'rb') as infile:
+            self.assertEqual(infile.read(), content)
+        # The second attempt only asked for the rest of the file.
+        downloads = server.headers
+        self.assertEqual(len(downloads), 2)
+        self.assertNotIn('Range', downloads[0])
+        resumed_at = int(downloads[1]['Range'].split('=')[1].rstrip('-'))
+        self.assertGreater(resumed_at, 0)
+
+    def test_download_file_failure(self):
+        self.mock_ctx('test_download_file_failure')
+        destination = os.path.join(self.work_dir, 'provider.zip')
+
+        def download_part(error):
+            def download(source, part_path):
+                with open(part_path, 'ab') as f:
+                    f.write(b'part')
+                raise error
+            return download
+
+        def http_error(status_code):
+            return requests.HTTPError(
+                response=Mock(status_code=status_code))
+
+        for error, attempts in [(IOError('Connection reset.'),
+                                 utils.DOWNLOAD_RETRIES),
+                                (http_error(503), utils.DOWNLOAD_RETRIES),
+                                (http_error(429), utils.DOWNLOAD_RETRIES),
+                                (http_error(404), 1),
+                                (http_error(403), 1)]:
+            with patch('cloudify_tf.utils._download_part',
+                       side_effect=download_part(error)) as download, \
+                    patch('cloudify_tf.utils.time.sleep'):
+                with self.assertRaises(NonRecoverableError):
+                    utils.download_file(
+                        destination, 'https://example.com/provider.zip')
+            # Only transient errors are retried.
+            self.assertEqual(download.call_count, attempts)
+            self.assertEqual(os.listdir(self.work_dir), [])
+
+        # Without a path, there is no file to download.
+        with patch('cloudify_tf.utils._download_part') as download:
+            with self.assertRaises(NonRecoverableError):
+                utils.download_file(destination, 'https://example.com')
+        self.assertFalse(download.called)
+
+    def test_download_file_reuses_connections(self):
+        self.mock_ctx('test_download_file_reuses_connections')
+        files = dict(('/provider{0}.zip'.format(i), b'provider')
+                     for i in range(3))
+        with http_stand_in(files) as (server, url):
+            for path in files:
+                utils.download_file(
+                    os.path.join(self.work_dir, path[1:]), url + path)
+        self.assertEqual(
+            len(set(client for _, _, client in server.received)), 1)
+
+    def test_download_file_checksum(self):
+        self.mock_ctx('test_download_file_checksum')
+        content = b'terraform'
+        checksum = hashlib.sha256(content).hexdigest()
+        destination = os.path.join(self.work_dir, 'terraform.zip')
+        path = '/terraform/0.13.3/terraform_0.13.3_linux_amd64.zip'
+        sums_path = '/terraform/0.13.3/terraform_0.13.3_SHA256SUMS'
+        files = {path: content,
+                 sums_path: '{0}  terraform_0.13.3_linux_amd64.zip\n'.format(
+                     '0' * 64).encode('utf-8')}
+        with http_stand_in(files) as (server, url):
+            # The checksums are only looked up on the hosts that publish
+            # them.
+            utils.download_file(destination, url + path)
+            self.assertEqual([request_path for _, request_path, _
+                              in server.received], [path])
+            with patch.object(utils, 'CHECKSUM_HOSTS', {'127.0.0.1'}):
+                with self.assertRaises(NonRecoverableError):
+                    utils.download_file(destination, url + path)
+                # The download was never moved to the destination.
+                self.assertEqual(os.listdir(self.work_dir), [])
+                files[sums_path] = '{0}  terraform_0.13.3_linux_amd64.zip\n'\
+                    .format(checksum).encode('utf-8')
+                utils.download_file(destination, url + path)
+                self.assertTrue(os.path.isfile(destination))
+            with self.assertRaises(NonRecoverableError):
+                utils.download_file(destination, url + path, '1' * 64)
+            self.assertEqual(os.listdir(self.work_dir), [])
+
+    def test_is_url(self):
+        self.assertFalse(utils.is_url('template.zip'))
+        self.assertFalse(utils.is_url('/tmp/template.zip'))
+        self.assertFalse(utils.is_url('git::https://example.com/x.git'))
+        self.assertTrue(utils.is_url('https://example.com/x.zip',
+                                     probe=False))
+        # Servers that do not allow HEAD, or URLs that are only signed for
+        # GET, are probed with a GET instead.
+        for head_status in (None, 405, 403):
+            with http_stand_in({'/template.zip': b'template'},
+                               head_status=head_status) as (server, url):
+                self.assertTrue(utils.is_url(url + '/template.zip'))
+                if not head_status:
+                    # The body is never requested.
+                    self.assertEqual(
+                        [command for command, _, _ in server.received],
+                        ['HEAD'])
+                self.assertFalse(utils.is_url(url + '/missing.zip'))
+
+    def test_handle_previous_source_format(self):
+        with http_stand_in({'/template.zip': b'template'}) as (_, url):
+            self.assertEqual(
+                utils.handle_previous_source_format(url + '/template.zip'),
+                {'location': url + '/template.zip'})
+        self.assertEqual(
+            utils.handle_previous_source_format('{"location": "a.zip"}'),
+            {'location': 'a.zip'})
+        self.assertEqual(utils.handle_previous_source_format('a.zip'),
+                         'a.zip')
+
+    def reload_source(self, server, url):
+        source = {'location': url + '/template.zip'}
+        utils.update_terraform_source_material(source)
+        return [command for command, _, _ in server.received]
+
+    def test_reload_source_not_modified(self):
+        for validators in (['etag'], ['last_modified'], []):
+            ctx = self.mock_ctx('test_reload_source_not_modified')
+            self.patch_workspace()
+            template = base64.b64decode(
+                self.make_material({'main.tf': 'resource "a" "b" {}'}))
+            with http_stand_in({'/template.zip': template},
+                               validators=validators) as (server, url):
+                if 'last_modified' in validators:
+                    server.last_modified['/template.zip'] = \
+                        'Mon, 01 Jan 2024 00:00:00 GMT'
+                self.reload_source(server, url)
+                runtime_properties = ctx.instance.runtime_properties
+                material = runtime_properties['terraform_source']
+                stored_validators = \
+                    runtime_properties[utils.SOURCE_VALIDATORS]
+                self.assertEqual(stored_validators['digest'],
+                                 hashlib.sha256(template).hexdigest())
+
+                # Not modified: the material is kept.
+                self.reload_source(server, url)
+                self.assertEqual(runtime_properties['terraform_source'],
+                                 material)
+                if validators:
+                    self.assertEqual(
+                        [headers for headers in server.headers
+                         if 'If-None-Match' in headers or
+                         'If-Modified-Since' in headers],
+                        server.headers[1:])
+
+                # Modified: the new material replaces the old one.
+                server.files['/template.zip'] = base64.b64decode(
+                    self.make_material({'main.tf': 'resource "a" "c" {}'}))
+                server.last_modified['/template.zip'] = \
+                    'Tue, 02 Jan 2024 00:00:00 GMT'
+                self.reload_source(server, url)
+                self.assertNotEqual(runtime_properties['terraform_source'],
+                                    material)
+
+    def test_resolved_once(self):
+        ctx = self.mock_ctx('test_resolved_once')
+        with patch('cloudify_tf.utils.get_deployment_dir',
+                   return_value=self.work_dir) as get_deployment_dir:
+            for _ in range(3):
+                storage_path = utils.get_storage_path()
+                self.assertEqual(utils.get_plugins_dir(),
+                                 os.path.join(storage_path,
+                                              '.terraform', 'plugins'))
+                utils.get_resource_config()
+            self.assertEqual(storage_path,
+                             os.path.join(self.work_dir, ctx.instance.id))
+            self.assertEqual(get_deployment_dir.call_count, 1)
+            self.assertEqual(utils.get_instance_update_count(), 1)
+
+            utils.invalidate_resolved_config()
+            utils.get_storage_path()
+            self.assertEqual(get_deployment_dir.call_count, 2)
+            self.assertEqual(utils.get_instance_update_count(), 2)
+
+        # Another operation resolves its own values.
+        self.mock_ctx('test_resolved_once')
+        self.assertEqual(utils.get_instance_update_count(), 0)
+
+    def test_flush_instance_updates_conflict(self):
+        ctx = self.mock_ctx('test_flush_instance_updates_conflict',
+                            runtime_properties={'a': 1, 'b': 2, 'c': 3,
+                                                'resources': {'x': {}}})
+        stored = {'a': 1, 'b': 2, 'c': 3, 'resources': {'x': {}},
+                  'other': 'concurrent'}
+
+        def update(on_conflict):
+            # Another operation updated the node instance in the meantime.
+            stored_after = on_conflict(
+                dict(ctx.instance.runtime_properties), stored)
+            stored.clear()
+            stored.update(stored_after)
+
+        utils.buffer_instance_updates()
+        with patch('cloudify_tf.utils.get_deployment_dir',
+                   return_value=self.work_dir):
+            storage_path = utils.get_storage_path()
+        ctx.instance.runtime_properties['a'] = 10
+        ctx.instance.runtime_properties.pop('c')
+        # A nested value changed in place.
+        ctx.instance.runtime_properties['resources']['y'] = {}
+        with patch.object(ctx.instance, 'update', side_effect=update):
+            utils.flush_instance_updates()
+        self.assertEqual(utils.get_instance_update_count(), 1)
+        self.assertEqual(stored, {'a': 10,
+                                  'b': 2,
+                                  'resources': {'x': {}, 'y': {}},
+                                  'other': 'concurrent',
+                                  'storage_path': storage_path})
+
+    def make_state(self, count):
+        return {
+            'version': 4,
+            'serial': 1,
+            'lineage': 'test',
+            'outputs': {
+                'ip': {'value': '10.0.0.1', 'type': 'string'},
+                'password': {'value': 'secret', 'type': 'string',
+                             'sensitive': True},
+            },
+            'resources': [{
+                'mode': 'managed',
+                'type': 'aws_instance',
+                'name': 'web_{0}'.format(i),
+                'provider': 'provider["registry.terraform.io/hashicorp/aws"]',
+                'instances': [{
+                    'schema_version': 1,
+                    'attributes': dict(
+                        [('id', 'i-{0}'.format(i))] +
+                        [('attribute_{0}'.format(j), 'x' * 32)
+                         for j in range(50)]),
+                    'sensitive_attributes': [],
+                    'private': 'x' * 200,
+                }],
+            } for i in range(count)],
+        }
+
+    def test_compact_resources_index(self):
+        state = self.make_state(1000)
+        full_ctx = self.mock_ctx('test_compact_resources_index')
+        utils.refresh_resources_properties(state)
+        compact_ctx = self.mock_ctx(
+            'test_compact_resources_index',
+            resource_config={'resources_index': {'compact': True}})
+        utils.refresh_resources_properties(state)
+
+        full = full_ctx.instance.runtime_properties
+        compact = compact_ctx.instance.runtime_properties
+        self.assertEqual(full['outputs'], {'ip': '10.0.0.1'})
+        self.assertEqual(compact['outputs'], {'ip': '10.0.0.1'})
+        self.assertEqual(full['resources']['web_7'], state['resources'][7])
+        self.assertEqual(compact['resources']['web_7'], {
+            'mode': 'managed',
+            'type': 'aws_instance',
+            'name': 'web_7',
+            'provider': 'provider["registry.terraform.io/hashicorp/aws"]',
+            'instances': [{'attributes': {'id': 'i-7'}}],
+        })
+        full_size = len(json.dumps(full['resources']))
+        compact_size = len(json.dumps(compact['resources']))
+        self.assertLess(compact_size * 10, full_size)
+
+    def test_resources_keys(self):
+        state = {'version': 4, 'resources': [
+            {'mode': 'managed', 'type': 'aws_instance', 'name': 'web',
+             'instances': [{'index_key': 0}, {'index_key': 1}]}]}
+        # By default, the resources are keyed by their name.
+        ctx = self.mock_ctx('test_resources_keys')
+        utils.refresh_resources_properties(state)
+        self.assertEqual(ctx.instance.runtime_properties['resources'],
+                         {'web': state['resources'][0]})
+
+        ctx = self.mock_ctx(
+            'test_resources_keys',
+            resource_config={'resources_index': {'keys': 'address'}})
+        utils.refresh_resources_properties(state)
+        self.assertEqual(sorted(ctx.instance.runtime_properties['resources']),
+                         ['aws_instance.web[0]', 'aws_instance.web[1]'])
+
+        legacy_state = {'version': 3, 'modules': [
+            {'path': ['root'],
+             'resources': {'aws_instance.web.0': {}}}]}
+        ctx = self.mock_ctx('test_resources_keys')
+        utils.refresh_resources_properties(legacy_state)
+        self.assertEqual(ctx.instance.runtime_properties['resources'],
+                         {'aws_instance.web.0': {}})
+
+    def test_iter_state_resources(self):
+        instance = {'attributes': {'id': 'a'}}
+        state = {
+            'version': 4,
+            'resources': [
+                {'mode': 'managed', 'type': 'aws_instance', 'name': 'web',
+                 'instances': [instance]},
+                {'mode': 'data', 'type': 'aws_ami', 'name': 'web',
+                 'instances': [instance]},
+                {'module': 'module.x', 'mode': 'managed',
+                 'type': 'aws_instance', 'name': 'web',
+                 'instances': [dict(instance, index_key=0),
+                               dict(instance, index_key=1)]},
+                {'mode': 'managed', 'type': 'aws_subnet', 'name': 'web',
+                 'instances': [dict(instance, index_key='a')]},
+                {'mode': 'managed', 'type': 'aws_eip', 'name': 'web',
+                 'instances': []},
+                {'mode': 'managed', 'type': 'aws_vpc', 'name': 'web'},
+            ],
+        }
+        resources = dict(utils.iter_state_resources(state))
+        self.assertEqual(sorted(resources), [
+            'aws_eip.web',
+            'aws_instance.web',
+            'aws_subnet.web["a"]',
+            'aws_vpc.web',
+            'data.aws_ami.web',
+            'module.x.aws_instance.web[0]',
+            'module.x.aws_instance.web[1]',
+        ])
+        # Resources without instances are listed, as they are by name.
+        self.assertEqual(resources['aws_eip.web'], state['resources'][4])
+        self.assertEqual(resources['aws_vpc.web'],
+                         dict(state['resources'][5], instances=[]))
+        self.assertIs(resources['aws_instance.web'], state['resources'][0])
+        self.assertEqual(resources['module.x.aws_instance.web[1]'],
+                         dict(state['resources'][2],
+                              instances=[dict(instance, index_key=1)]))
+
+        legacy_state = {
+            'version': 3,
+            'modules': [
+                {'path': ['root'],
+                 'resources': {'aws_instance.web': {'type': 'aws_instance'},
+                               'data.aws_ami.web': {'type': 'aws_ami'}}},
+                {'path': ['root', 'x'],
+                 'resources': {'aws_instance.web.0': {},
+                               'aws_instance.web.1': {}}},
+            ],
+        }
+        self.assertEqual(sorted(dict(utils.iter_state_resources(
+            legacy_state))), [
+            'aws_instance.web',
+            'data.aws_ami.web',
+            'module.x.aws_instance.web[0]',
+            'module.x.aws_instance.web[1]',
+        ])
+
+    @requires_py3
+    def test_run_subprocess_multiplexed(self):
+        command = [sys.executable, '-c', '\n'.join([
+            'import sys, time',
+            'for i in range(100000):',
+            '    sys.stdout.write("line %d\\n" % i)',
+            'sys.stdout.flush()',
+            'time.sleep(0.5)',
+            'sys.stderr.write("done\\n")'])]
+        logger = logging.getLogger('test_run_subprocess_multiplexed')
+
+        def run(**kwargs):
+            with self.assertLogs(logger) as logs:
+                output = utils.run_subprocess(
+                    command, logger, self.work_dir, **kwargs)
+            lines = '\n'.join(
+                record.getMessage() for record in logs.records[1:-1])
+            return output, len(logs.records), lines.splitlines()
+
+        with patch('cloudify_tf.utils.LoggingOutputConsumer') as consumer:
+            _, records, lines = run()
+            output, _, _ = run(return_output=True)
+        self.assertFalse(consumer.called)
+        # The lines are logged in batches, and in order.
+        self.assertLess(records, 100)
+        self.assertEqual(len(lines), 100001)
+        self.assertEqual(lines[12345], '<out> line 12345')
+        self.assertEqual(lines[-1], '<err> done')
+        self.assertEqual(len(output.splitlines()), 100000)
+
+        with patch('cloudify_tf.utils.selectors', None):
+            _, records, _ = run()
+        self.assertGreater(records, 100000)
+
+    @requires_py3
+    def test_run_subprocess_spooled_output(self):
+        logger = logging.getLogger('test_run_subprocess_spooled_output')
+        for size, rolled in [(1000, False), (5000000, True)]:
+            command = [sys.executable, '-c',
+                       'for _ in range({0}): print("x" * 999)'.format(
+                           size // 1000)]
+            tracemalloc.start()
+            try:
+                with self.assertLogs(logger) as logs:
+                    output = utils.run_subprocess(
+                        command, logger, self.work_dir,
+                        return_output=utils.STREAM_OUTPUT)
+                peak = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+            with output:
+                self.assertEqual(output._rolled, rolled)
+                content = output.read()
+            self.assertEqual(len(content), size)
+            self.assertLess(peak, 2 * utils.OUTPUT_SPOOL_SIZE)
+            self.assertEqual(
+                logs.output[-1],
+                'INFO:{0}:Returning output: {1} bytes, sha256 {2}.'.format(
+                    logger.name, size, hashlib.sha256(content).hexdigest()))
@@ -0,0 +1,79 @@
+########
+# Copyright (c) 2018-2020 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+from mock import MagicMock
+
+from ..workflows import _terraform_operation
+
+
+class TestWorkflows(unittest.TestCase):
+
+    def mock_node_instance(self, node_instance_id, targets=None):
+        node_instance = MagicMock()
+        node_instance.id = node_instance_id
+        node_instance.node.id = node_instance_id.split('_')[0]
+        node_instance.node.type_hierarchy = [
+            'cloudify.nodes.Root', 'cloudify.nodes.terraform.Module']
+        node_instance.relationships = []
+        for target_id in targets or []:
+            relationship = MagicMock()
+            relationship.target_id = target_id
+            node_instance.relationships.append(relationship)
+        return node_instance
+
+    def mock_ctx(self, node_instances):
+        ctx = MagicMock()
+        ctx.node_instances = node_instances
+        graph = ctx.graph_mode.return_value
+        graph.subgraph.side_effect = lambda name: MagicMock(name=name)
+        return ctx, graph
+
+    def dependencies(self, graph):
+        # The index of each node instance in the subgraph name.
+        return sorted(
+            tuple(subgraph._mock_name.rsplit('_', 1)[1]
+                  for subgraph in call[0])
+            for call in graph.add_dependency.call_args_list)
+
+    def test_max_concurrency(self):
+        ctx, graph = self.mock_ctx([
+            self.mock_node_instance('module_{0}'.format(i))
+            for i in range(5)])
+        _terraform_operation(ctx, 'terraform.refresh', [], [],
+                             max_concurrency=2)
+        self.assertEqual(graph.subgraph.call_count, 5)
+        self.assertEqual(self.dependencies(graph),
+                         [('2', '0'), ('3', '1'), ('4', '2')])
+
+    def test_sequential_by_default(self):
+        ctx, graph = self.mock_ctx([
+            self.mock_node_instance('module_{0}'.format(i))
+            for i in range(3)])
+        _terraform_operation(ctx, 'terraform.refresh', [], [])
+        self.assertEqual(self.dependencies(graph), [('1', '0'), ('2', '1')])
+
+    def test_relationships(self):
+        # module_0 runs on module_2, so it comes after it.
+        ctx, graph = self.mock_ctx([
+            self.mock_node_instance('module_0', targets=['module_2']),
+            self.mock_node_instance('module_1'),
+            self.mock_node_instance('module_2'),
+            self.mock_node_instance('other_3', targets=['module_1'])])
+        _terraform_operation(ctx, 'terraform.refresh', [], [],
+                             max_concurrency=10)
+        self.assertEqual(self.dependencies(graph),
+                         [('0', '2'), ('3', '1')])
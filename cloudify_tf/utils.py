@@ -16,19 +16,32 @@
 import os
 import copy
 import json
-import base64
+import stat
+import binascii
 import ntpath
+import fnmatch
+import hashlib
+import fcntl
+import signal
+import errno
+import uuid
+import inspect
 import shutil
 import zipfile
 import filecmp
+import time
 import tempfile
 import requests
+import weakref
 import threading
 import subprocess
-from io import BytesIO
-from contextlib import contextmanager
+from functools import wraps
+from contextlib import contextmanager, closing
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 
 from cloudify import ctx
+from cloudify.state import current_ctx
 from cloudify.exceptions import NonRecoverableError
 from cloudify_common_sdk.utils import get_deployment_dir
 from cloudify_common_sdk.resource_downloader import unzip_archive
@@ -43,9 +56,55 @@ except ImportError:
     RELATIONSHIP_INSTANCE = 'relationship-instance'
 
 from . import TERRAFORM_BACKEND
-from ._compat import text_type, StringIO, PermissionDenied, mkdir_p
+from ._compat import (text_type,
+                      urlparse,
+                      PermissionDenied,
+                      mkdir_p,
+                      selectors,
+                      encodebytes)
 
 TERRAFORM_STATE_FILE = 'terraform.tfstate'
+WORKSPACE_MANIFEST = '.cloudify_tf_workspace.json'
+# The entry that marks an archive as a package of the workspace itself,
+# rather than a raw source that source_path applies to.
+WORKSPACE_MARKER = '.cloudify_tf_workspace'
+# Base64 encodes 57 bytes per line, so keep chunks a multiple of that.
+BASE64_CHUNK_SIZE = 57 * 1024
+SOURCE_VALIDATORS = 'last_source_validators'
+
+# How many plugins are downloaded at the same time.
+MAX_PLUGIN_DOWNLOADS = 4
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+DOWNLOAD_RETRIES = 3
+# Connect and read timeouts, in seconds.
+DOWNLOAD_TIMEOUT = (10, 60)
+# The hosts that publish the SHA256SUMS of their releases next to them.
+CHECKSUM_HOSTS = {'releases.hashicorp.com'}
+# The environment variable of the agent that sets the number of slots of
+# the semaphore that all the terraform commands on the host share, and the
+# default number of slots per CPU.
+HOST_SLOTS_ENV = 'CLOUDIFY_TF_HOST_SLOTS'
+HOST_SLOTS_PER_CPU = 4
+# The longest wait between attempts to take host slots, in seconds.
+MAX_HOST_SLOTS_BACKOFF = 0.5
+# The runtime property that records the -parallelism of the last run.
+PARALLELISM = 'terraform_parallelism'
+# Terraform's own default -parallelism.
+DEFAULT_PARALLELISM = 10
+MAX_PARALLELISM = 80
+# With auto parallelism, modules with at least this many resources get a
+# higher parallelism while the load of the host per CPU is below
+# IDLE_HOST_LOAD.
+LARGE_MODULE_RESOURCES = 100
+IDLE_HOST_LOAD = 0.5
+# How long a command has to exit once it is interrupted on its timeout,
+# before it is killed.
+KILL_GRACE_PERIOD = 10
+# Captured output is kept in memory up to this size, and in a temporary
+# file past it.
+OUTPUT_SPOOL_SIZE = 1024 * 1024
+# Pass as return_output to run_subprocess to get the output as a file.
+STREAM_OUTPUT = 'stream'
 
 MASKED_ENV_VARS = {
     'AWS_ACCESS_KEY_ID',
@@ -53,8 +112,147 @@ MASKED_ENV_VARS = {
 }
 
 
-def download_file(source, destination):
-    run_subprocess(['curl', '-o', source, destination])
+_http_session = None
+# Per operation context: the config values resolved during the operation,
+# and the number of updates of the node instance sent to the manager.
+_operation_states = weakref.WeakKeyDictionary()
+_operation_states_lock = threading.Lock()
+_http_session_lock = threading.Lock()
+
+
+def get_http_session():
+    """A session shared by all the downloads, so that connections to the
+    same host are kept alive and reused.
+    """
+    global _http_session
+    with _http_session_lock:
+        if _http_session is None:
+            _http_session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_maxsize=MAX_PLUGIN_DOWNLOADS)
+            _http_session.mount('http://', adapter)
+            _http_session.mount('https://', adapter)
+    return _http_session
+
+
+def _download_part(source, part_path):
+    """Download source into part_path, resuming from where a previous
+    download into it stopped, if the server supports ranges.
+    """
+    headers = {}
+    offset = os.path.getsize(part_path) if os.path.isfile(part_path) else 0
+    if offset:
+        headers['Range'] = 'bytes={0}-'.format(offset)
+    response = get_http_session().get(
+        source, headers=headers, stream=True, timeout=DOWNLOAD_TIMEOUT)
+    with closing(response):
+        if offset and response.status_code == 416:
+            # The previous download was complete.
+            return
+        response.raise_for_status()
+        mode = 'ab' if response.status_code == 206 else 'wb'
+        size = 0
+        with open(part_path, mode) as f:
+            for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                f.write(chunk)
+                size += len(chunk)
+        expected_size = response.headers.get('Content-Length')
+        if expected_size and int(expected_size) != size:
+            raise IOError('Received {size} of {expected} bytes.'.format(
+                size=size, expected=expected_size))
+
+
+def get_published_checksum(source):
+    """HashiCorp publishes the checksums of each release next to it, e.g.
+    terraform_0.13.3_SHA256SUMS for terraform_0.13.3_linux_amd64.zip.
+    Returns None if source is not on one of the CHECKSUM_HOSTS, or if there
+    is no such file.
+    """
+    parsed_url = urlparse(source)
+    if parsed_url.hostname not in CHECKSUM_HOSTS:
+        return
+    base_path, _, file_name = parsed_url.path.rpartition('/')
+    name_parts = file_name.split('_')
+    if len(name_parts) < 3:
+        return
+    sums_url = '{scheme}://{host}{path}/{name}_{version}_SHA256SUMS'.format(
+        scheme=parsed_url.scheme,
+        host=parsed_url.netloc,
+        path=base_path,
+        name=name_parts[0],
+        version=name_parts[1])
+    try:
+        response = get_http_session().get(sums_url, timeout=DOWNLOAD_TIMEOUT)
+    except requests.RequestException:
+        return
+    if not response.ok:
+        ctx.logger.debug('No published checksums at {url}.'.format(
+            url=sums_url))
+        return
+    for line in response.text.splitlines():
+        fields = line.split()
+        if len(fields) == 2 and fields[1] == file_name:
+            return fields[0]
+
+
+def _is_transient_error(error):
+    """Connection errors, timeouts and incomplete downloads are worth
+    retrying, but of the HTTP errors, only 5xx and 429 responses are.
+    """
+    response = getattr(error, 'response', None)
+    if isinstance(error, requests.HTTPError) and response is not None:
+        return response.status_code >= 500 or response.status_code == 429
+    return True
+
+
+def _download_with_retries(source, part_path):
+    for attempt in range(1, DOWNLOAD_RETRIES + 1):
+        try:
+            _download_part(source, part_path)
+            return
+        except (requests.RequestException, IOError) as e:
+            if attempt == DOWNLOAD_RETRIES or not _is_transient_error(e):
+                raise NonRecoverableError(
+                    'Failed to download {source}: {err}'.format(
+                        source=source, err=e))
+            ctx.logger.warn(
+                'Failed to download {source}, retrying: {err}'.format(
+                    source=source, err=e))
+            time.sleep(attempt)
+
+
+def download_file(destination, source, checksum=None):
+    """Download source into destination, in chunks, retrying and resuming
+    interrupted downloads.
+    The file is verified against the SHA256 checksum, if one is given or
+    published next to it, before it is moved to destination. Local paths
+    and file:// URLs are copied. If anything fails, neither the partial
+    download nor destination is left behind.
+    """
+    parsed_url = urlparse(source)
+    is_local = parsed_url.scheme in ('', 'file')
+    if not is_local:
+        if not parsed_url.path.rpartition('/')[2]:
+            raise NonRecoverableError(
+                'The URL {source} does not point to a file.'.format(
+                    source=source))
+        checksum = checksum or get_published_checksum(source)
+    part_path = destination + '.part'
+    try:
+        if is_local:
+            shutil.copyfile(parsed_url.path, part_path)
+        else:
+            _download_with_retries(source, part_path)
+        if checksum and _file_sha256(part_path) != checksum:
+            raise NonRecoverableError(
+                'The checksum of {source} does not match {checksum}.'.format(
+                    source=source, checksum=checksum))
+        os.rename(part_path, destination)
+    except BaseException:
+        for file_path in (part_path, destination):
+            if os.path.isfile(file_path):
+                os.remove(file_path)
+        raise
 
 
 def run_subprocess(command,
@@ -62,8 +260,24 @@ def run_subprocess(command,
                    cwd=None,
                    additional_env=None,
                    additional_args=None,
-                   return_output=False):
-    """Execute a shell script or command."""
+                   return_output=False,
+                   stdout_parser=None,
+                   stderr_handler=None,
+                   timeout=None,
+                   kill_grace_period=KILL_GRACE_PERIOD):
+    """Execute a shell script or command.
+    With return_output, the output is returned as text, or with
+    STREAM_OUTPUT, as a file positioned at its start, which the caller
+    closes. Only its size and digest are logged.
+    With stdout_parser, the output is handed to it as it is produced, e.g.
+    parse_json_output, and what it returns is returned, without logging or
+    holding on to the output itself.
+    stderr_handler is called with each line of stderr, as well as logging
+    it.
+    A command that does not finish within timeout seconds is interrupted
+    with SIGINT, so that it can stop gracefully, and killed if it did not
+    exit within kill_grace_period seconds of that.
+    """
 
     logger = logger or ctx.logger
     cwd = cwd or get_node_instance_dir()
@@ -99,67 +313,179 @@ def run_subprocess(command,
         cwd=cwd,
         **args_to_pass)
 
-    if return_output:
-        stdout_consumer = CapturingOutputConsumer(
-            process.stdout)
-    else:
-        stdout_consumer = LoggingOutputConsumer(
-            process.stdout, logger, '<out> ')
-    stderr_consumer = LoggingOutputConsumer(
-        process.stderr, logger, '<err> ')
+    timed_out = []
+    if timeout:
+        def interrupt():
+            if process.poll() is not None:
+                return
+            timed_out.append(True)
+            logger.error(
+                '{cmd} did not finish within {timeout}s; stopping it.'.format(
+                    cmd=command, timeout=timeout))
+            stop_process(process, kill_grace_period, logger)
+        timer = threading.Timer(timeout, interrupt)
+        timer.daemon = True
+        timer.start()
 
-    return_code = process.wait()
-    stdout_consumer.join()
-    stderr_consumer.join()
+    try:
+        stdout_consumer, return_code = _consume_output(
+            process, logger, return_output, stdout_parser, stderr_handler)
+    finally:
+        if timeout:
+            timer.cancel()
 
+    if timed_out:
+        raise NonRecoverableError(
+            '{cmd} did not finish within {timeout}s.'.format(
+                cmd=command, timeout=timeout))
     if return_code:
         raise subprocess.CalledProcessError(return_code, command)
 
-    output = stdout_consumer.buffer.getvalue() if return_output else None
-    logger.info('Returning output:\n{output}'.format(
-        output=output if output is not None else '<None>'))
-    return output
+    if stdout_parser:
+        if stdout_consumer.error:
+            raise stdout_consumer.error
+        logger.info('Parsed the output of {cmd}.'.format(cmd=command))
+        return stdout_consumer.result
+
+    if not return_output:
+        logger.info('Returning output:\n<None>')
+        return
+    output = stdout_consumer.buffer
+    logger.info('Returning output: {summary}.'.format(
+        summary=output.summary()))
+    if return_output == STREAM_OUTPUT:
+        return output.stream()
+    return output.getvalue()
+
+
+def stop_process(process, kill_grace_period=KILL_GRACE_PERIOD, logger=None):
+    """Interrupt the process with SIGINT, and kill it if it did not exit
+    within kill_grace_period seconds.
+    """
+    logger = logger or ctx.logger
+    if process.poll() is not None:
+        return
+    process.send_signal(signal.SIGINT)
+    deadline = time.time() + kill_grace_period
+    while process.poll() is None:
+        if time.time() > deadline:
+            logger.error(
+                'The process {pid} did not exit within {seconds}s of being '
+                'interrupted; killing it.'.format(
+                    pid=process.pid, seconds=kill_grace_period))
+            process.kill()
+            return
+        time.sleep(0.1)
+
+
+def _consume_output(process,
+                    logger,
+                    return_output,
+                    stdout_parser,
+                    stderr_handler):
+    """Log, capture or parse the output of the process until it exits, and
+    return the consumer of its stdout along with its return code.
+    """
+    if selectors and not stdout_parser:
+        # Both pipes are read from this thread.
+        stdout_consumer = OutputMultiplexer(
+            process.stdout, process.stderr, logger, return_output,
+            stderr_handler)
+        stdout_consumer.run()
+        return_code = process.wait()
+    else:
+        if stdout_parser:
+            stdout_consumer = ParsingOutputConsumer(
+                process.stdout, stdout_parser)
+        elif return_output:
+            stdout_consumer = CapturingOutputConsumer(
+                process.stdout)
+        else:
+            stdout_consumer = LoggingOutputConsumer(
+                process.stdout, logger, '<out> ')
+        stderr_consumer = LoggingOutputConsumer(
+            process.stderr, logger, '<err> ', stderr_handler)
+
+        return_code = process.wait()
+        stdout_consumer.join()
+        stderr_consumer.join()
+    return stdout_consumer, return_code
+
 
+def parse_json_output(out):
+    """Parse the JSON output of a command, or None if there is none."""
+    output = out.read().decode('utf-8')
+    if output.strip():
+        return json.loads(output)
 
-def exclude_file(dirname, filename, excluded_files):
-    """In _zip_archive, we need to prevent certain files, i.e. the TF binary,
-    from being added  to the zip. It's totally unnecessary,
+
+def compile_exclusions(root_dir, excluded_files):
+    """In _zip_archive, we need to prevent certain files, i.e. the TF binary
+    and plugins, from being added to the zip. It's totally unnecessary,
     and also crashes the manager.
+
+    The excluded files are resolved once, into a set of paths relative to
+    root_dir, and a list of glob patterns. Patterns without a slash match
+    file names, e.g. "*.tfplan", and "dir/**" matches a whole directory.
     """
-    rel_path = os.path.join(dirname, filename)
-    for f in excluded_files:
+    paths = set()
+    patterns = []
+    for f in excluded_files or []:
         if not f:
             continue
-        elif os.path.isfile(f) and rel_path == f:
-            return True
-        elif os.path.isdir(f) and f in rel_path:
+        elif any(c in f for c in '*?['):
+            if f.endswith('/**'):
+                f = f[:-3]
+            patterns.append(f)
+            continue
+        rel_path = os.path.relpath(os.path.join(root_dir, f), root_dir)
+        if rel_path.split(os.sep)[0] != os.pardir:
+            paths.add(rel_path)
+    return paths, patterns
+
+
+def is_excluded(rel_path, exclusions):
+    paths, patterns = exclusions
+    if rel_path in paths:
+        return True
+    posix_path = rel_path.replace(os.sep, '/')
+    name = ntpath.basename(posix_path)
+    for pattern in patterns:
+        if fnmatch.fnmatchcase(name if '/' not in pattern else posix_path,
+                               pattern):
             return True
     return False
 
 
-def exclude_dirs(dirname, subdirs, excluded_files):
-    """In _zip_archive, we need to prevent certain files, i.e. TF plugins,
-    from being added  to the zip. It's totally unnecessary,
-    and also crashes the manager.
+def walk_files(root_dir, excluded_files=None):
+    """Yield the path and the path relative to root_dir of every file
+    under root_dir, without descending into excluded directories.
     """
-    rel_subdirs = [os.path.join(dirname, d) for d in subdirs]
-    for f in excluded_files:
-        if not f:
-            continue
-        if os.path.isdir(f) and f in rel_subdirs:
-            try:
-                subdirs.remove(ntpath.basename(f))
-            except ValueError:
-                pass
+    exclusions = compile_exclusions(root_dir, excluded_files)
+    for dir_name, subdirs, filenames in os.walk(root_dir):
+        rel_dir = os.path.relpath(dir_name, root_dir)
+        if rel_dir == os.curdir:
+            rel_dir = ''
+        # Prune the excluded directories, so that os.walk skips them.
+        subdirs[:] = [d for d in subdirs
+                      if not is_excluded(os.path.join(rel_dir, d),
+                                         exclusions)]
+        for filename in filenames:
+            rel_path = os.path.join(rel_dir, filename)
+            if not is_excluded(rel_path, exclusions):
+                yield os.path.join(dir_name, filename), rel_path
 
 
-def _zip_archive(extracted_source, exclude_files=None, **_):
+def _zip_archive(extracted_source, exclude_files=None, workspace=False,
+                 **_):
     """Zip up a folder and all its sub-folders,
     except for those that we wish to exclude.
 
     :param extracted_source: The location.
     :param exclude_files: A list of files and directories, that we don't
-    want to put in the zip.
+    want to put in the zip, or glob patterns of them.
+    :param workspace: Whether the folder is the workspace, in which case the
+    archive is marked with WORKSPACE_MARKER.
     :param _:
     :return:
     """
@@ -172,31 +498,25 @@ def _zip_archive(extracted_source, exclude_files=None, **_):
         with zipfile.ZipFile(updated_zip.name,
                              mode='w',
                              compression=zipfile.ZIP_DEFLATED) as output_file:
-            for dir_name, subdirs, filenames in os.walk(extracted_source):
-                # Make sure that the files that we don't want
-                # to include (e.g. plugins directory) will not be archived.
-                exclude_dirs(dir_name, subdirs, exclude_files)
-                for filename in filenames:
-                    # Extra layer of validation on the excluded files.
-                    if not exclude_file(dir_name, filename, exclude_files):
-                        # Create the path as we want to archive it to the
-                        # archivee.
-                        file_to_add = os.path.join(dir_name, filename)
-                        # The name of the file in the archive.
-                        arc_name = file_to_add[len(extracted_source)+1:]
-                        output_file.write(file_to_add, arcname=arc_name)
+            for file_to_add, arc_name in walk_files(extracted_source,
+                                                    exclude_files):
+                output_file.write(file_to_add, arcname=arc_name)
+            if workspace:
+                output_file.writestr(WORKSPACE_MARKER, '')
         archive_file_path = updated_zip.name
     return archive_file_path
 
 
 def _unzip_archive(archive_path, target_directory, source_path=None, **_):
     """
-    Unzip a zip archive.
+    Unzip a zip archive in a single pass.
+
+    When source_path is given, only the entries under it are extracted,
+    relative to it. If no entry is under source_path, everything is
+    extracted. source_path does not apply to packages of the workspace
+    itself, which are extracted whole.
     """
 
-    # Create a temporary directory.
-    # Create a zip archive object.
-    # Extract the object.
     target_directory = target_directory if \
         target_directory.endswith('/') else target_directory + '/'
 
@@ -208,18 +528,88 @@ def _unzip_archive(archive_path, target_directory, source_path=None, **_):
         a=archive_path, b=source_path, c=target_directory))
 
     with zipfile.ZipFile(archive_path, 'r') as zip_ref:
-        for p in zip_ref.namelist():
-            if source_path in p:
-                zip_ref.extract(p, target_directory)
-                reset_source = os.path.join(target_directory, p)
-                reset_target = os.path.join(
-                    target_directory, ntpath.basename(p))
-                os.rename(reset_source, reset_target)
-            else:
-                zip_ref.extractall(target_directory)
+        if WORKSPACE_MARKER in zip_ref.namelist():
+            ctx.logger.debug('Extracting a package of the workspace.')
+            source_path = None
+        members = _select_zip_members(zip_ref, source_path)
+        if source_path and not members:
+            ctx.logger.debug('No entries under {path}, '
+                             'extracting the whole archive.'.format(
+                                 path=source_path))
+            members = _select_zip_members(zip_ref)
+        entries, size = _extract_zip_members(
+            zip_ref, members, target_directory)
+    ctx.logger.debug('Extracted {entries} entries, {size} bytes '
+                     'to {loc}.'.format(entries=entries,
+                                        size=size,
+                                        loc=target_directory))
     return target_directory
 
 
+def _source_path_prefix(names, source_path):
+    """The prefix of the entries under source_path: source_path itself at
+    the root of the archive, or under the single top level directory of the
+    archive, for example in archives of GitHub repositories.
+    Returns None if no entry is under source_path.
+    """
+    if any(name.startswith(source_path) for name in names):
+        return source_path
+    top_levels = set(name.split('/', 1)[0] for name in names)
+    if len(top_levels) == 1:
+        prefix = '{0}/{1}'.format(top_levels.pop(), source_path)
+        if any(name.startswith(prefix) for name in names):
+            return prefix
+
+
+def _select_zip_members(zip_ref, source_path=None):
+    """List the entries of the archive to extract, each with its path
+    relative to the source_path, see _source_path_prefix.
+    source_path must end with a slash, so that only whole directories
+    match.
+    """
+    prefix = ''
+    if source_path:
+        prefix = _source_path_prefix(zip_ref.namelist(), source_path)
+        if prefix is None:
+            return []
+    members = []
+    for info in zip_ref.infolist():
+        if not info.filename.startswith(prefix):
+            continue
+        rel_path = info.filename[len(prefix):]
+        if not rel_path or rel_path == WORKSPACE_MARKER:
+            continue
+        members.append((info, rel_path))
+    return members
+
+
+def _extract_zip_members(zip_ref, members, target_directory):
+    """Stream the entries into place and return how many entries and bytes
+    were extracted.
+    """
+    entries = 0
+    size = 0
+    for info, rel_path in members:
+        norm_path = os.path.normpath(rel_path)
+        if os.path.isabs(norm_path) or \
+                norm_path.split(os.sep)[0] == os.pardir:
+            ctx.logger.warn('Skipping archive entry {name} outside of '
+                            'the target directory.'.format(
+                                name=info.filename))
+            continue
+        target_path = os.path.join(target_directory, norm_path)
+        if info.filename.endswith('/'):
+            mkdir_p(target_path)
+            continue
+        mkdir_p(os.path.dirname(target_path))
+        with zip_ref.open(info) as source, \
+                open(target_path, 'wb') as target:
+            shutil.copyfileobj(source, target)
+        entries += 1
+        size += info.file_size
+    return entries, size
+
+
 def clean_strings(string):
     if isinstance(string, text_type):
         return string.encode('utf-8').rstrip("'").lstrip("'")
@@ -231,10 +621,29 @@ def _file_to_base64(file_path):
     # file containing the Terraform files.
     # We need to encode the contents of the file and set them
     # as a runtime property.
-    base64_rep = BytesIO()
+    # The file is encoded a chunk at a time, into the same line format
+    # as base64.encode.
+    base64_rep = []
     with open(file_path, 'rb') as f:
-        base64.encode(f, base64_rep)
-    return base64_rep.getvalue().decode('utf-8')
+        for chunk in iter(lambda: f.read(BASE64_CHUNK_SIZE), b''):
+            base64_rep.append(encodebytes(chunk).decode('utf-8'))
+    return ''.join(base64_rep)
+
+
+def _base64_to_file(data, target_file):
+    """Decode the base64 data into an open binary file, a chunk at a time,
+    rather than copying the whole data into a buffer first.
+    """
+    remainder = ''
+    for offset in range(0, len(data), BASE64_CHUNK_SIZE):
+        chunk = remainder + ''.join(
+            data[offset:offset + BASE64_CHUNK_SIZE].split())
+        # Only whole 4 character groups can be decoded on their own.
+        decodable = len(chunk) - len(chunk) % 4
+        target_file.write(binascii.a2b_base64(chunk[:decodable]))
+        remainder = chunk[decodable:]
+    if remainder:
+        target_file.write(binascii.a2b_base64(remainder))
 
 
 def _create_source_path(source_tmp_path):
@@ -256,32 +665,38 @@ def _create_source_path(source_tmp_path):
     return source_tmp_path
 
 
-def set_permissions(target_file):
-    run_subprocess(
-        ['chmod', 'u+x', target_file],
-        ctx.logger
-    )
+def set_permissions(target_file, mode=None):
+    """Make the file executable by its owner, like "chmod u+x", but without
+    spawning a process. If a mode is given, it is applied as well.
+    """
+    if not mode:
+        mode = stat.S_IMODE(os.stat(target_file).st_mode)
+    os.chmod(target_file, mode | stat.S_IXUSR)
 
 
 def unzip_and_set_permissions(zip_file, target_dir):
-    """Unzip a file and fix permissions on the files."""
+    """Unzip a file and fix permissions on the files.
+    The permissions are taken from the archive, where they were stored.
+    """
     ctx.logger.debug('Unzipping into {dir}.'.format(dir=target_dir))
 
     with zipfile.ZipFile(zip_file, 'r') as zip_ref:
-        for name in zip_ref.namelist():
+        members = zip_ref.infolist()
+        for info in members:
             try:
-                zip_ref.extract(name, target_dir)
+                zip_ref.extract(info, target_dir)
             except PermissionDenied as e:
                 raise NonRecoverableError(
                     'Attempted to download a file {name} to {folder}. '
                     'Failed with permission denied {err}.'.format(
-                        name=name,
+                        name=info.filename,
                         folder=target_dir,
                         err=e))
-            target_file = os.path.join(target_dir, name)
-            ctx.logger.info('Setting executable permission on '
-                            '{loc}.'.format(loc=target_file))
-            set_permissions(target_file)
+            # The high bits of the external attributes are the Unix mode.
+            set_permissions(os.path.join(target_dir, info.filename),
+                            stat.S_IMODE(info.external_attr >> 16))
+    ctx.logger.info('Set executable permission on {count} files '
+                    'in {loc}.'.format(count=len(members), loc=target_dir))
 
 
 def get_instance(_ctx=None, target=False, source=False):
@@ -350,24 +765,353 @@ def find_rels_by_type(node_instance, rel_type):
             if rel_type in x.type_hierarchy]
 
 
+def get_shared_cache_dir():
+    """A directory shared by all the deployments on the manager, i.e.
+    /opt/manager/resources/deployments/.terraform_cache
+    """
+    deployments_dir = os.path.dirname(
+        os.path.dirname(get_deployment_dir(ctx.deployment.id)))
+    cache_dir = os.path.join(deployments_dir, '.terraform_cache')
+    mkdir_p(cache_dir)
+    return cache_dir
+
+
+@contextmanager
+def file_lock(lock_path):
+    """Hold an exclusive lock on lock_path, across processes and threads."""
+    with open(lock_path, 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def get_host_slots(slots=None):
+    """The number of host slots: the one set in the HOST_SLOTS_ENV
+    environment variable of the agent, or HOST_SLOTS_PER_CPU per CPU.
+    The number is a setting of the host rather than of the blueprints, so
+    that all the deployments share the same bound.
+    """
+    return slots or int(os.environ.get(HOST_SLOTS_ENV) or 0) or \
+        HOST_SLOTS_PER_CPU * cpu_count()
+
+
+def _try_lock_slot(slot_path):
+    slot_file = open(slot_path, 'a')
+    try:
+        fcntl.flock(slot_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except (IOError, OSError) as e:
+        slot_file.close()
+        if e.errno not in (errno.EAGAIN, errno.EACCES):
+            raise
+        return
+    return slot_file
+
+
+def release_host_slots(held_slots):
+    for slot_file in held_slots:
+        fcntl.flock(slot_file, fcntl.LOCK_UN)
+        slot_file.close()
+
+
+def get_host_slots_dir():
+    slots_dir = os.path.join(get_shared_cache_dir(), 'slots')
+    mkdir_p(slots_dir)
+    return slots_dir
+
+
+def _enqueue_host_slots_waiter(queue_dir):
+    """Add an entry to the queue of the waiters for host slots, named by
+    the time it was added. The entry is locked for as long as its waiter
+    lives, so that the entries of dead waiters can be told apart.
+    """
+    name = '{0:020d}-{1}-{2}'.format(
+        int(time.time() * 1000000), os.getpid(), uuid.uuid4().hex)
+    # The entry is locked before it is visible under its name.
+    temporary_path = os.path.join(queue_dir, '.' + name)
+    entry = _try_lock_slot(temporary_path)
+    os.rename(temporary_path, os.path.join(queue_dir, name))
+    return name, entry
+
+
+def _dequeue_host_slots_waiter(queue_dir, name, entry):
+    try:
+        os.remove(os.path.join(queue_dir, name))
+    finally:
+        release_host_slots([entry])
+
+
+def _is_first_waiter(queue_dir, name):
+    """Whether the entry is the oldest one of a live waiter in the queue.
+    The entries of dead waiters are removed on the way.
+    """
+    for other in sorted(os.listdir(queue_dir)):
+        if other == name:
+            return True
+        if other.startswith('.'):
+            continue
+        other_path = os.path.join(queue_dir, other)
+        other_entry = _try_lock_slot(other_path)
+        if not other_entry:
+            return False
+        try:
+            os.remove(other_path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        finally:
+            release_host_slots([other_entry])
+    return False
+
+
+def acquire_host_slots(weight, slots=None, slots_dir=None):
+    """Take weight of the slots of a semaphore that is shared by all the
+    processes on the host, where each slot is a file lock in the shared
+    cache.
+    The waiters queue up, first come first served: only the first one in
+    the queue takes slots, and it holds them until it has all it needs, so
+    that a stream of light commands does not starve the heavy ones. As
+    the other waiters hold no slots, this does not deadlock.
+    Returns the held slots, for release_host_slots.
+    """
+    slots = get_host_slots(slots)
+    weight = max(1, min(weight, slots))
+    slots_dir = slots_dir or get_host_slots_dir()
+    queue_dir = os.path.join(slots_dir, 'queue')
+    mkdir_p(queue_dir)
+    name, entry = _enqueue_host_slots_waiter(queue_dir)
+    held_slots = {}
+    try:
+        backoff = 0.01
+        while True:
+            if _is_first_waiter(queue_dir, name):
+                for index in range(slots):
+                    if len(held_slots) == weight:
+                        break
+                    if index in held_slots:
+                        continue
+                    slot_file = _try_lock_slot(os.path.join(
+                        slots_dir, 'slot-{0}.lock'.format(index)))
+                    if slot_file:
+                        held_slots[index] = slot_file
+                if len(held_slots) == weight:
+                    return list(held_slots.values())
+            time.sleep(backoff)
+            backoff = min(backoff * 2, MAX_HOST_SLOTS_BACKOFF)
+    except BaseException:
+        release_host_slots(held_slots.values())
+        raise
+    finally:
+        _dequeue_host_slots_waiter(queue_dir, name, entry)
+
+
+def log_host_slots_wait(logger, started, held_slots, slots=None):
+    logger.info('Waited {seconds:.1f}s for {weight} of {slots} host '
+                'slots.'.format(seconds=time.time() - started,
+                                weight=len(held_slots),
+                                slots=get_host_slots(slots)))
+
+
+@contextmanager
+def host_slots(weight, slots=None, logger=None):
+    """Hold weight of the host slots, and log how long it took to get
+    them.
+    """
+    started = time.time()
+    held_slots = acquire_host_slots(weight, slots)
+    log_host_slots_wait(logger or ctx.logger, started, held_slots, slots)
+    try:
+        yield
+    finally:
+        release_host_slots(held_slots)
+
+
+def _file_sha256(file_path):
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(BASE64_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _link_file(source, target):
+    """Hard link target to source, or symlink it if source is on another
+    file system.
+    """
+    mkdir_p(os.path.dirname(target))
+    if os.path.lexists(target):
+        os.remove(target)
+    try:
+        os.link(source, target)
+    except OSError:
+        os.symlink(source, target)
+
+
+def _binary_reference(executable_path):
+    return hashlib.sha256(executable_path.encode('utf-8')).hexdigest()
+
+
 def install_binary(
         installation_dir,
         executable_path,
-        installation_source=None):
+        installation_source=None,
+        installation_checksum=None):
+    """Link executable_path to the binary from installation_source in the
+    shared cache, downloading it if it isn't there yet.
+    The cached binary counts its references, see release_binary.
+    """
 
     if installation_source:
-        installation_zip = os.path.join(installation_dir, 'tf.zip')
-        ctx.logger.info(
-            'Downloading Terraform from {source} into {zip}.'.format(
-                source=installation_source,
-                zip=installation_zip))
-        download_file(installation_zip, installation_source)
-        executable_dir = os.path.dirname(executable_path)
-        unzip_and_set_permissions(installation_zip, executable_dir)
-        os.remove(installation_zip)
+        cache_key = hashlib.sha256(json.dumps(
+            [installation_source, installation_checksum]).encode(
+                'utf-8')).hexdigest()
+        cache_entry = os.path.join(get_shared_cache_dir(), 'terraform',
+                                   cache_key)
+        cached_binary = os.path.join(cache_entry, 'terraform')
+        mkdir_p(os.path.dirname(cache_entry))
+        with file_lock(cache_entry + '.lock'):
+            # release_binary removes the entry under the same lock.
+            mkdir_p(os.path.join(cache_entry, 'refs'))
+            if os.path.isfile(cached_binary):
+                ctx.logger.info(
+                    'Using the cached Terraform from {source} '
+                    'in {loc}.'.format(source=installation_source,
+                                       loc=cache_entry))
+            else:
+                installation_zip = os.path.join(cache_entry, 'tf.zip')
+                ctx.logger.info(
+                    'Downloading Terraform from {source} into {zip}.'.format(
+                        source=installation_source,
+                        zip=installation_zip))
+                download_file(installation_zip,
+                              installation_source,
+                              installation_checksum)
+                unzip_and_set_permissions(installation_zip, cache_entry)
+                os.remove(installation_zip)
+            with open(os.path.join(cache_entry, 'refs', _binary_reference(
+                    executable_path)), 'w') as ref:
+                ref.write(executable_path)
+        _link_file(cached_binary, executable_path)
+        ctx.instance.runtime_properties['shared_executable_path'] = \
+            cached_binary
     return executable_path
 
 
+def release_binary(cached_binary, executable_path):
+    """Remove the link at executable_path to the shared binary, and remove
+    the binary from the cache once nothing refers to it anymore.
+    """
+    cache_entry = os.path.dirname(cached_binary)
+    refs_dir = os.path.join(cache_entry, 'refs')
+    with file_lock(cache_entry + '.lock'):
+        ref = os.path.join(refs_dir, _binary_reference(executable_path))
+        if os.path.isfile(ref):
+            os.remove(ref)
+        if os.path.lexists(executable_path):
+            ctx.logger.info('Removing executable: {path}'.format(
+                path=executable_path))
+            os.remove(executable_path)
+        if os.path.isdir(refs_dir) and not os.listdir(refs_dir):
+            ctx.logger.info(
+                'Removing unused cached Terraform {loc}.'.format(
+                    loc=cache_entry))
+            shutil.rmtree(cache_entry)
+
+
+def _get_operation_state():
+    with _operation_states_lock:
+        return _operation_states.setdefault(
+            current_ctx.get_ctx(),
+            {'resolved': {}, 'instance_updates': 0, 'buffered': []})
+
+
+def resolved_once(func):
+    """Resolve the value of a config getter once per operation, instead of
+    walking the context and the file system on every call.
+    Call invalidate_resolved_config after changing what it depends on.
+    """
+    @wraps(func)
+    def resolve(*args, **kwargs):
+        resolved = _get_operation_state()['resolved']
+        key = (func.__name__, tuple(sorted(
+            inspect.getcallargs(func, *args, **kwargs).items())))
+        if key not in resolved:
+            resolved[key] = func(*args, **kwargs)
+        return resolved[key]
+    return resolve
+
+
+def invalidate_resolved_config():
+    """Resolve the config values again on their next use."""
+    _get_operation_state()['resolved'].clear()
+
+
+def _send_instance_update(instance, on_conflict):
+    _get_operation_state()['instance_updates'] += 1
+    instance.update(on_conflict=on_conflict)
+
+
+def update_instance(instance):
+    """Send the node instance runtime properties to the manager, unless the
+    operation buffers its updates, in which case they are sent once when it
+    ends by flush_instance_updates.
+    """
+    state = _get_operation_state()
+    if any(buffered is instance for buffered, _ in state['buffered']):
+        return
+    _send_instance_update(instance, lambda local, latest: local)
+
+
+def buffer_instance_updates():
+    """Record the runtime properties of the node instances of the current
+    operation, so that only the keys that the operation changes are sent
+    when it ends.
+    """
+    _ctx = current_ctx.get_ctx()
+    if _ctx.type == RELATIONSHIP_INSTANCE:
+        instances = [_ctx.source.instance, _ctx.target.instance]
+    else:
+        instances = [_ctx.instance]
+    # A deep copy, so that changes made in place to nested values are
+    # detected as well.
+    _get_operation_state()['buffered'] = [
+        (instance, copy.deepcopy(dict(instance.runtime_properties)))
+        for instance in instances]
+
+
+def flush_instance_updates():
+    """Send the runtime properties changed since buffer_instance_updates,
+    with one update per node instance.
+    On a version conflict, the changed keys are applied on top of the
+    runtime properties in storage.
+    """
+    state = _get_operation_state()
+    buffered, state['buffered'] = state['buffered'], []
+    for instance, before in buffered:
+        after = instance.runtime_properties
+        changed = [key for key, value in after.items()
+                   if key not in before or before[key] != value]
+        deleted = [key for key in before if key not in after]
+        if not changed and not deleted:
+            continue
+
+        def merge(local, latest, changed=changed, deleted=deleted):
+            merged = dict(latest)
+            for key in changed:
+                merged[key] = local[key]
+            for key in deleted:
+                merged.pop(key, None)
+            return merged
+        _send_instance_update(instance, merge)
+
+
+def get_instance_update_count():
+    """The number of node instance updates sent during this operation."""
+    return _get_operation_state()['instance_updates']
+
+
+@resolved_once
 def get_resource_config(target=False):
     """Get the cloudify.nodes.terraform.Module resource_config"""
     ctx.logger.debug('Getting resource config.')
@@ -381,6 +1125,7 @@ def get_resource_config(target=False):
     return node.properties.get('resource_config', {})
 
 
+@resolved_once
 def get_terraform_config(target=False):
     """get the cloudify.nodes.terraform or cloudify.nodes.terraform.Module
     terraform_config"""
@@ -395,16 +1140,98 @@ def get_terraform_config(target=False):
     return node.properties.get('terraform_config', {})
 
 
+def _get_source_archive_type(location):
+    """The archive type of an HTTP(S) source, or None if the source is not
+    an archive that we can download ourselves, e.g. a git repository.
+    """
+    if not is_url(location, probe=False):
+        return
+    file_name = location.split('?')[0].rsplit('/', 1)[-1]
+    file_type = file_name.rsplit('.', 1)[-1] if '.' in file_name else ''
+    if file_type == 'zip' or file_type in TAR_FILE_EXTENSTIONS:
+        return file_type
+
+
+def _download_source_if_modified(location,
+                                 file_type,
+                                 target_dir,
+                                 validators=None,
+                                 auth=None):
+    """Download an archive source, unless the origin reports that it was
+    not modified since the validators were recorded, or its content digest
+    is the same.
+    Returns the path of the downloaded archive and its new validators, or
+    (None, None) if the source did not change.
+    """
+    validators = validators or {}
+    headers = {}
+    if validators.get('etag'):
+        headers['If-None-Match'] = validators['etag']
+    if validators.get('last_modified'):
+        headers['If-Modified-Since'] = validators['last_modified']
+    with closing(get_http_session().get(location,
+                                        headers=headers,
+                                        auth=auth,
+                                        stream=True,
+                                        timeout=DOWNLOAD_TIMEOUT)) as response:
+        if response.status_code == 304:
+            return None, None
+        response.raise_for_status()
+        digest = hashlib.sha256()
+        with tempfile.NamedTemporaryFile(suffix='.' + file_type,
+                                         dir=target_dir,
+                                         delete=False) as outfile:
+            for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                digest.update(chunk)
+                outfile.write(chunk)
+        new_validators = {
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'digest': digest.hexdigest(),
+        }
+    if new_validators['digest'] == validators.get('digest'):
+        os.remove(outfile.name)
+        return None, None
+    return outfile.name, new_validators
+
+
 def update_terraform_source_material(new_source, target=False):
     """Replace the terraform_source material with a new material.
-    This is used in terraform.reload_template operation."""
+    This is used in terraform.reload_template operation.
+    If the new source is the archive at the last source location, and it was
+    not modified since, the stored material is kept as is."""
     ctx.logger.debug('Updating source material.')
     instance = get_instance(target=target)
     new_source_location = new_source['location']
-    source_tmp_path = get_shared_resource(
-        new_source_location, dir=get_node_instance_dir(target=target),
-        username=new_source.get('username'),
-        password=new_source.get('password'))
+    validators = None
+    file_type = _get_source_archive_type(new_source_location)
+    if file_type:
+        if new_source_location == \
+                instance.runtime_properties.get('last_source_location') \
+                and instance.runtime_properties.get('terraform_source'):
+            validators = instance.runtime_properties.get(SOURCE_VALIDATORS)
+        auth = None
+        if new_source.get('username'):
+            auth = (new_source['username'], new_source.get('password'))
+        archive_path, new_validators = _download_source_if_modified(
+            new_source_location,
+            file_type,
+            get_node_instance_dir(target=target),
+            validators,
+            auth)
+        if not archive_path:
+            ctx.logger.info(
+                'The source at {loc} was not modified, keeping the stored '
+                'source material.'.format(loc=new_source_location))
+            return instance.runtime_properties['terraform_source']
+        source_tmp_path = _create_source_path(archive_path)
+        os.remove(archive_path)
+    else:
+        new_validators = None
+        source_tmp_path = get_shared_resource(
+            new_source_location, dir=get_node_instance_dir(target=target),
+            username=new_source.get('username'),
+            password=new_source.get('password'))
     ctx.logger.debug('The shared resource path is {loc}'.format(
         loc=source_tmp_path))
 
@@ -421,9 +1248,13 @@ def update_terraform_source_material(new_source, target=False):
 
     instance.runtime_properties['terraform_source'] = base64_rep
     instance.runtime_properties['last_source_location'] = new_source_location
+    if new_validators:
+        instance.runtime_properties[SOURCE_VALIDATORS] = new_validators
+    else:
+        instance.runtime_properties.pop(SOURCE_VALIDATORS, None)
     ctx.logger.debug('Updated source material {l}.'.format(
         l=new_source_location))
-    instance.update()
+    update_instance(instance)
     return base64_rep
 
 
@@ -457,6 +1288,7 @@ def get_installation_source(target=False):
     return source
 
 
+@resolved_once
 def get_executable_path(target=False):
     """The Terraform binary executable.
     It should either be: null, in which case it defaults to
@@ -484,6 +1316,7 @@ def get_executable_path(target=False):
     return executable_path
 
 
+@resolved_once
 def get_storage_path(target=False):
     """Where we install all of our terraform files.
     It should always be: /opt/manager/resources/deployments/{tenant}
@@ -500,10 +1333,11 @@ def get_storage_path(target=False):
         loc=deployment_dir))
     instance = get_instance(target=target)
     instance.runtime_properties['storage_path'] = deployment_dir
-    instance.update()
+    update_instance(instance)
     return deployment_dir
 
 
+@resolved_once
 def get_plugins_dir(target=False):
     """Plugins are installed into this directory.
     It should always be: /opt/manager/resources/deployments/{tenant}
@@ -530,6 +1364,61 @@ def get_plugins(target=False):
     return resource_config.get('plugins', {})
 
 
+def _get_host_load():
+    """The load average of the last minute, per CPU."""
+    return os.getloadavg()[0] / cpu_count()
+
+
+def parse_parallelism(parallelism):
+    """The parallelism property as a positive integer, "auto", or None if
+    it is not set. Integers may be given as strings, e.g. by inputs.
+    """
+    if parallelism is None or parallelism == '':
+        return
+    text = text_type(parallelism).strip()
+    if text.lower() == 'auto':
+        return 'auto'
+    try:
+        value = int(text)
+    except ValueError:
+        value = 0
+    if isinstance(parallelism, bool) or value < 1:
+        raise NonRecoverableError(
+            'The parallelism must be a positive integer or "auto", '
+            'not {parallelism!r}.'.format(parallelism=parallelism))
+    return value
+
+
+def get_parallelism(parallelism=None):
+    """The -parallelism of the terraform commands: either the configured
+    number, or, with "auto", the value of the last run, raised for large
+    modules while the host is idle, unless the last run hit rate limits.
+    """
+    parallelism = parse_parallelism(parallelism)
+    if parallelism != 'auto':
+        return parallelism
+    runtime_properties = get_instance().runtime_properties
+    last_run = runtime_properties.get(PARALLELISM) or {}
+    value = last_run.get('value', DEFAULT_PARALLELISM)
+    if not last_run.get('rate_limited') and \
+            len(runtime_properties.get('resources') or {}) >= \
+            LARGE_MODULE_RESOURCES and \
+            _get_host_load() < IDLE_HOST_LOAD:
+        value = min(value * 2, MAX_PARALLELISM)
+    return value
+
+
+def record_parallelism(tf):
+    """Record the -parallelism that the run ended with, and whether it hit
+    rate limits, for the next run to tune it.
+    """
+    if tf.parallelism:
+        get_instance().runtime_properties[PARALLELISM] = {
+            'value': tf.parallelism,
+            'rate_limited': tf.rate_limit_errors > 0,
+        }
+
+
 def get_source_path(target=False):
     resource_config = get_resource_config(target=target)
     return resource_config.get('source_path')
@@ -562,9 +1451,48 @@ def remove_dir(folder, desc=''):
             'Directory {dir} doesn\'t exist; skipping'.format(dir=folder))
 
 
+def _get_mirrored_plugin(plugin_url, installation_dir, checksum=None):
+    """Return the directory of the plugin from plugin_url in the plugins
+    mirror shared by all the deployments, downloading it if it isn't there
+    yet.
+    """
+    mirror_key = hashlib.sha256(json.dumps(
+        [plugin_url, checksum]).encode('utf-8')).hexdigest()
+    mirror_entry = os.path.join(get_shared_cache_dir(), 'plugins', mirror_key)
+    with file_lock(mirror_entry + '.lock'):
+        if os.path.isdir(mirror_entry):
+            ctx.logger.info(
+                'Using the mirrored Terraform plugin: {url}'.format(
+                    url=plugin_url))
+            return mirror_entry
+        with tempfile.NamedTemporaryFile(
+                suffix=".zip",
+                delete=False,
+                dir=installation_dir) as plugin_zip:
+            plugin_zip.close()
+        # Extract next to the entry, so that it only appears once it is
+        # complete.
+        extracted = tempfile.mkdtemp(dir=os.path.dirname(mirror_entry))
+        try:
+            ctx.logger.info('Downloading Terraform plugin: {url}'.format(
+                url=plugin_url))
+            download_file(plugin_zip.name, plugin_url, checksum)
+            unzip_and_set_permissions(plugin_zip.name, extracted)
+            os.rename(extracted, mirror_entry)
+        finally:
+            if os.path.isfile(plugin_zip.name):
+                os.remove(plugin_zip.name)
+            if os.path.isdir(extracted):
+                shutil.rmtree(extracted)
+    return mirror_entry
+
+
 def handle_plugins(plugins, plugins_dir, installation_dir):
     """Create the directory where we will download requested plugins into,
-    and then download them into it."""
+    and then download them into it.
+    The plugins are downloaded concurrently into a mirror shared by all the
+    deployments, and linked from there.
+    """
     create_plugins_dir(plugins_dir)
     # Install plugins.
     if not isinstance(plugins, dict):
@@ -581,19 +1509,35 @@ def handle_plugins(plugins, plugins_dir, installation_dir):
             'terraform-provider-template_2.1.2_linux_amd64.zip\n'.format(
                 value=plugins)
         )
-    for plugin_name, plugin_url in plugins.items():
-        with tempfile.NamedTemporaryFile(
-                suffix=".zip",
-                delete=False,
-                dir=installation_dir) as plugin_zip:
-            plugin_zip.close()
-            ctx.logger.info('Downloading Terraform plugin: {url}'.format(
-                url=plugin_url))
-            download_file(plugin_zip.name, plugin_url)
+    if not plugins:
+        return
+    mkdir_p(os.path.join(get_shared_cache_dir(), 'plugins'))
+    operation_ctx = current_ctx.get_ctx()
+
+    def install_plugin(plugin):
+        plugin_name, plugin_url = plugin
+        # A plugin is either a URL or a dictionary with a URL and the
+        # SHA256 checksum of the file.
+        checksum = None
+        if isinstance(plugin_url, dict):
+            checksum = plugin_url.get('checksum')
+            plugin_url = plugin_url['url']
+        current_ctx.set(operation_ctx)
+        try:
+            mirror_entry = _get_mirrored_plugin(
+                plugin_url, installation_dir, checksum)
             unzip_path = os.path.join(plugins_dir, plugin_name)
-            mkdir_p(os.path.dirname(unzip_path))
-            unzip_and_set_permissions(plugin_zip.name, unzip_path)
-            os.remove(plugin_zip.name)
+            for file_path, rel_path in walk_files(mirror_entry):
+                _link_file(file_path, os.path.join(unzip_path, rel_path))
+        finally:
+            current_ctx.clear()
+
+    pool = ThreadPool(min(len(plugins), MAX_PLUGIN_DOWNLOADS))
+    try:
+        pool.map(install_plugin, sorted(plugins.items()))
+    finally:
+        pool.close()
+        pool.join()
 
 
 def handle_backend(root_dir):
@@ -604,6 +1548,12 @@ def handle_backend(root_dir):
             backend['name'], backend.get('options', {}))
         backend_file_path = os.path.join(
             root_dir, '{0}.tf'.format(backend['name']))
+        # Leave an identical backend file untouched, so that its mtime
+        # does not invalidate the workspace manifest.
+        if os.path.isfile(backend_file_path):
+            with open(backend_file_path, 'r') as outfile:
+                if outfile.read() == backend_string:
+                    return
         with open(backend_file_path, 'w') as infile:
             infile.write(backend_string)
     ctx.logger.debug('Extracted Terraform files: {loc}'.format(loc=root_dir))
@@ -612,7 +1562,7 @@ def handle_backend(root_dir):
 def extract_binary_tf_data(root_dir, data, source_path):
     """Take this encoded data and put it in a zip file and then unzip it."""
     with tempfile.NamedTemporaryFile(dir=root_dir, delete=False) as f:
-        base64.decode(StringIO(data), f)
+        _base64_to_file(data, f)
         terraform_source_zip = f.name
 
     # By getting here, "terraform_source_zip" is the path
@@ -638,35 +1588,124 @@ def update_terraform_source(new_source):
     return _yield_terraform_source(material)
 
 
+def _source_digest(material):
+    """A digest of the stored source material, used as the workspace key."""
+    return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+
+def _snapshot_workspace(root_dir, exclude_files=None):
+    """Map every file under root_dir, relative to it, to its size and mtime.
+    The excluded files are the same ones that _zip_archive skips.
+    """
+    snapshot = {}
+    for file_path, rel_path in walk_files(root_dir, exclude_files):
+        try:
+            file_stat = os.stat(file_path)
+        except OSError:
+            # Broken symlinks and the like are not archived either.
+            continue
+        snapshot[rel_path] = [file_stat.st_size, file_stat.st_mtime]
+    return snapshot
+
+
+def _read_workspace_manifest(root_dir):
+    manifest_path = os.path.join(root_dir, WORKSPACE_MANIFEST)
+    if not os.path.isfile(manifest_path):
+        return {}
+    try:
+        with open(manifest_path, 'r') as infile:
+            return json.load(infile)
+    except ValueError:
+        ctx.logger.debug(
+            'Ignoring unreadable workspace manifest {loc}.'.format(
+                loc=manifest_path))
+        return {}
+
+
+def _write_workspace_manifest(root_dir, digest, snapshot):
+    manifest_path = os.path.join(root_dir, WORKSPACE_MANIFEST)
+    with open(manifest_path, 'w') as outfile:
+        json.dump({'digest': digest, 'files': snapshot}, outfile)
+
+
+def _get_workspace_excludes(root_dir):
+    """The files that are never packaged into the terraform source."""
+    return [get_executable_path(),
+            get_plugins_dir(),
+            os.path.join(root_dir, WORKSPACE_MANIFEST),
+            '*.tfplan']
+
+
+def _store_workspace(module_root, exclude_files):
+    """Package the workspace into the source material in the runtime
+    properties.
+    Returns the digest of what was stored, or None if the source was
+    removed by the operation, e.g. by destroy, and nothing was stored.
+    """
+    runtime_properties = ctx.instance.runtime_properties
+    if runtime_properties.get('terraform_source') is None:
+        ctx.logger.debug(
+            'The terraform source was removed; not storing {loc}.'.format(
+                loc=module_root))
+        return
+    ctx.logger.debug('Re-packaging Terraform files from {loc}'.format(
+        loc=module_root))
+    archived_file = _zip_archive(
+        module_root, exclude_files=exclude_files, workspace=True)
+    # Convert the zip archive into base64 for storage in runtime
+    # properties.
+    base64_rep = _file_to_base64(archived_file)
+    os.remove(archived_file)
+    ctx.logger.warn('The after base64_rep size is {size}.'.format(
+        size=len(base64_rep)))
+    runtime_properties['terraform_source'] = base64_rep
+    return _source_digest(base64_rep)
+
+
 def _yield_terraform_source(material):
     """Put all the TF resource template data into the work directory,
     let the operations do all their magic,
     and then store it again for later use.
+
+    The work directory is keyed by the digest of the material: if it
+    already holds an untouched extraction of the same material, extraction
+    is skipped, and the changes are only stored if a file under it
+    changed while the operation ran.
     """
     module_root = get_storage_path()
     handle_backend(module_root)
     source_path = get_source_path()
-    extract_binary_tf_data(module_root, material, source_path)
+    exclude_files = _get_workspace_excludes(module_root)
+    digest = _source_digest(material)
+    manifest = _read_workspace_manifest(module_root)
+    snapshot = _snapshot_workspace(module_root, exclude_files)
+    if manifest.get('digest') == digest and \
+            manifest.get('files') == snapshot:
+        ctx.logger.debug(
+            'Workspace {loc} is up to date with source {digest}; '
+            'skipping extraction.'.format(loc=module_root, digest=digest))
+    else:
+        extract_binary_tf_data(module_root, material, source_path)
+        snapshot = _snapshot_workspace(module_root, exclude_files)
+        _write_workspace_manifest(module_root, digest, snapshot)
     try:
         yield get_node_instance_dir()
     finally:
-        ctx.logger.debug('Re-packaging Terraform files from {loc}'.format(
-            loc=module_root))
-        archived_file = _zip_archive(
-            module_root,
-            exclude_files=[get_executable_path(),
-                           get_plugins_dir()])
-        # Convert the zip archive into base64 for storage in runtime
-        # properties.
-        base64_rep = _file_to_base64(archived_file)
-        os.remove(archived_file)
-        ctx.logger.warn('The after base64_rep size is {size}.'.format(
-            size=len(base64_rep)))
-        ctx.instance.runtime_properties['terraform_source'] = base64_rep
+        current_snapshot = _snapshot_workspace(module_root, exclude_files)
+        if current_snapshot == snapshot:
+            ctx.logger.debug(
+                'No changes in {loc}; skipping re-packaging.'.format(
+                    loc=module_root))
+        else:
+            digest = _store_workspace(module_root, exclude_files)
+            if digest:
+                _write_workspace_manifest(
+                    module_root, digest, current_snapshot)
         ctx.instance.runtime_properties['resource_config'] = \
             get_resource_config()
 
 
+@resolved_once
 def get_node_instance_dir(target=False, source=False):
     """This is the place where the magic happens.
     We put all our binaries, templates, or symlinks to those files here,
@@ -696,7 +1735,7 @@ def get_terraform_state_file(ctx):
     source_path = get_source_path()
 
     with tempfile.NamedTemporaryFile(delete=False) as f:
-        base64.decode(StringIO(encoded_source), f)
+        _base64_to_file(encoded_source, f)
         terraform_source_zip = f.name
 
     extracted_source = _unzip_archive(terraform_source_zip,
@@ -735,22 +1774,215 @@ def create_backend_string(name, options):
     return 'terraform {\n%s\n}' % backend_block
 
 
-def refresh_resources_properties(state):
-    """Store all the resources that we created as JSON in the context."""
-    resources = {}
+def get_terraform_fingerprint(root_module,
+                              variables,
+                              environment_variables,
+                              executable_path):
+    """A digest of everything that the result of an apply depends on:
+    the module files, the variables and environment variables, the resource
+    config and the Terraform binary. The binary is identified by its path,
+    size and mtime, rather than by running "terraform version".
+    """
+    digest = hashlib.sha256()
+    digest.update(json.dumps([
+        variables,
+        environment_variables,
+        get_resource_config(),
+    ], sort_keys=True).encode('utf-8'))
+    if os.path.isfile(executable_path):
+        binary_stat = os.stat(executable_path)
+        digest.update(json.dumps([executable_path,
+                                  binary_stat.st_size,
+                                  binary_stat.st_mtime]).encode('utf-8'))
+    # Terraform itself writes the state and the .terraform directory,
+    # so they are not inputs.
+    exclude_files = _get_workspace_excludes(root_module) + [
+        TERRAFORM_STATE_FILE + '*', '.terraform/**']
+    for file_path, rel_path in sorted(walk_files(root_module, exclude_files),
+                                      key=lambda f: f[1]):
+        digest.update(rel_path.encode('utf-8'))
+        with open(file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(BASE64_CHUNK_SIZE), b''):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+def get_state_version(state):
+    """The lineage and serial of a pulled state. Terraform increments the
+    serial whenever the state changes.
+    """
+    state = state or {}
+    return [state.get('lineage'), state.get('serial')]
+
+
+def _select_attributes(attributes, selected):
+    return dict((name, attributes[name]) for name in selected
+                if name in attributes)
+
+
+def _compact_resource(resource, selected):
+    """The type, name and provider of a resource, with only the selected
+    attributes of its instances.
+    """
+    if 'primary' in resource:
+        # A resource of a module in the legacy state format.
+        primary = resource['primary'] or {}
+        return {
+            'type': resource.get('type'),
+            'provider': resource.get('provider'),
+            'primary': {
+                'id': primary.get('id'),
+                'attributes': _select_attributes(
+                    primary.get('attributes', {}), selected),
+            },
+        }
+    compact = dict((key, resource[key])
+                   for key in ('module', 'mode', 'type', 'name', 'provider')
+                   if key in resource)
+    compact['instances'] = []
+    for instance in resource.get('instances', []):
+        compact_instance = {'attributes': _select_attributes(
+            instance.get('attributes', {}), selected)}
+        if 'index_key' in instance:
+            compact_instance['index_key'] = instance['index_key']
+        compact['instances'].append(compact_instance)
+    return compact
+
+
+def get_state_outputs(state):
+    """The values of the outputs of the root module, except the sensitive
+    ones.
+    """
+    outputs = state.get('outputs')
+    if outputs is None:
+        # The legacy state format.
+        outputs = {}
+        for module in state.get('modules', []):
+            if module.get('path') == ['root']:
+                outputs = module.get('outputs', {})
+    return dict((name, output.get('value'))
+                for name, output in outputs.items()
+                if not output.get('sensitive'))
+
+
+def _instance_address(resource_address, index_key):
+    if index_key is None:
+        return resource_address
+    return '{0}[{1}]'.format(resource_address, json.dumps(index_key))
+
+
+def _iter_legacy_resources(module):
+    """The resources of a module in the state format of Terraform 0.11 and
+    below, keyed like "aws_instance.web.0" within the module.
+    """
+    prefix = ''.join('module.{0}.'.format(name)
+                     for name in module.get('path', ['root'])[1:])
+    for key, definition in module.get('resources', {}).items():
+        parts = key.split('.')
+        type_and_name = 3 if parts[0] == 'data' else 2
+        index_key = None
+        if len(parts) > type_and_name and parts[type_and_name].isdigit():
+            index_key = int(parts[type_and_name])
+        address = prefix + '.'.join(parts[:type_and_name])
+        yield _instance_address(address, index_key), definition
+
+
+def iter_state_resources(state):
+    """Yield the address of each resource instance in the state, e.g.
+    module.x.aws_instance.web[0], along with its definition.
+    In the state format of Terraform 0.12 and above, the definition is the
+    resource with only that instance in its instances. A resource without
+    instances, e.g. with a count of 0, is yielded by its address, with no
+    instances.
+    """
     for resource in state.get('resources', []):
-        resources[resource['name']] = resource
+        address = '{0}.{1}'.format(resource['type'], resource['name'])
+        if resource.get('mode') == 'data':
+            address = 'data.' + address
+        if resource.get('module'):
+            address = '{0}.{1}'.format(resource['module'], address)
+        instances = resource.get('instances', [])
+        if not instances:
+            yield address, dict(resource, instances=[])
+            continue
+        if len(instances) == 1 and 'index_key' not in instances[0]:
+            yield address, resource
+            continue
+        for instance in instances:
+            definition = dict(resource)
+            definition['instances'] = [instance]
+            yield (_instance_address(address, instance.get('index_key')),
+                   definition)
+    for module in state.get('modules', []):
+        for address, definition in _iter_legacy_resources(module):
+            yield address, definition
+
+
+def iter_named_resources(state):
+    """Yield each resource in the state keyed by its name, or in the legacy
+    state format by its key within its module, e.g. aws_instance.web.0.
+    Resources with the same name in different modules share a key.
+    """
+    for resource in state.get('resources', []):
+        yield resource['name'], resource
     for module in state.get('modules', []):
         for name, definition in module.get('resources', {}).items():
-            resources[name] = definition
-    ctx.instance.runtime_properties['resources'] = resources
+            yield name, definition
 
 
-def is_url(string):
+def refresh_resources_properties(state):
+    """Store all the resources that we created as JSON in the context,
+    along with the outputs.
+    The resources are keyed by their name, or, if the resources_index keys
+    are "address", by the address of each resource instance.
+    With a compact resources_index, only the type, name, provider and the
+    selected attributes of each resource are stored. The full state remains
+    in the module's backend.
+    """
+    resources_index = get_resource_config().get('resources_index') or {}
+    if resources_index.get('keys') == 'address':
+        resources = iter_state_resources(state)
+    else:
+        resources = iter_named_resources(state)
+    if resources_index.get('compact'):
+        selected = resources_index.get('attributes', ['id'])
+
+        def project(resource):
+            return _compact_resource(resource, selected)
+    else:
+        def project(resource):
+            return resource
+    ctx.instance.runtime_properties['resources'] = dict(
+        (key, project(definition))
+        for key, definition in resources)
+    ctx.instance.runtime_properties['outputs'] = get_state_outputs(state)
+
+
+def is_url(string, probe=True):
+    """Whether the string is an HTTP(S) URL, and if probe is set, whether
+    the resource at it is reachable.
+    The probe is a HEAD request, or if that fails, e.g. because the server
+    does not allow HEAD or the URL is only signed for GET, a GET that is
+    closed as soon as the headers arrive, so that the body is never
+    downloaded.
+    """
+    parsed_url = urlparse(string)
+    if parsed_url.scheme not in ('http', 'https') or not parsed_url.netloc:
+        return False
+    if not probe:
+        return True
+    session = get_http_session()
     try:
-        return requests.get(string)
-    except requests.ConnectionError:
+        response = session.head(
+            string, allow_redirects=True, timeout=DOWNLOAD_TIMEOUT)
+        if not response.ok:
+            with closing(session.get(string,
+                                     stream=True,
+                                     timeout=DOWNLOAD_TIMEOUT)) as response:
+                return response.ok
+    except requests.RequestException:
         return False
+    return response.ok
 
 
 def handle_previous_source_format(source):
@@ -785,25 +2017,238 @@ class OutputConsumer(object):
 
 
 class LoggingOutputConsumer(OutputConsumer):
-    def __init__(self, out, logger, prefix):
+    def __init__(self, out, logger, prefix, line_handler=None):
         OutputConsumer.__init__(self, out)
         self.logger = logger
         self.prefix = prefix
+        self.line_handler = line_handler
         self.consumer.start()
 
     def handle_line(self, line):
-        self.logger.info('{0}{1}'.format(text_type(self.prefix),
-                                         line.decode('utf-8').rstrip('\n')))
+        line = line.decode('utf-8').rstrip('\n')
+        if self.line_handler:
+            self.line_handler(line)
+        self.logger.info('{0}{1}'.format(text_type(self.prefix), line))
+
+
+class SpooledOutput(object):
+    """Captured output, kept in memory up to OUTPUT_SPOOL_SIZE, and in a
+    temporary file past it.
+    """
+
+    def __init__(self, max_size=OUTPUT_SPOOL_SIZE):
+        self.file = tempfile.SpooledTemporaryFile(max_size=max_size)
+        self.digest = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.file.write(data)
+        self.digest.update(data)
+        self.size += len(data)
+
+    def summary(self):
+        return '{size} bytes, sha256 {digest}'.format(
+            size=self.size, digest=self.digest.hexdigest())
+
+    def stream(self):
+        self.file.seek(0)
+        return self.file
+
+    def getvalue(self):
+        with closing(self.stream()) as output:
+            return output.read().decode('utf-8')
 
 
 class CapturingOutputConsumer(OutputConsumer):
     def __init__(self, out):
         OutputConsumer.__init__(self, out)
-        self.buffer = StringIO()
+        self.buffer = SpooledOutput()
         self.consumer.start()
 
     def handle_line(self, line):
-        self.buffer.write(line.decode('utf-8'))
+        self.buffer.write(line)
 
     def get_buffer(self):
         return self.buffer
+
+
+class OutputMultiplexer(object):
+    """Reads the stdout and stderr of a process from a single thread, and
+    logs their lines in batches, in the order that they were read.
+    A batch is logged once it is large enough, or old enough.
+    """
+
+    read_size = 64 * 1024
+    max_batch_size = 64 * 1024
+    max_batch_delay = 1.0
+
+    def __init__(self, out, err, logger, capture_out=False,
+                 err_handler=None):
+        self.out = out
+        self.err = err
+        self.logger = logger
+        self.err_handler = err_handler
+        self.buffer = SpooledOutput() if capture_out else None
+        self.batch = []
+        self.batch_size = 0
+        self.batch_started = None
+
+    def run(self):
+        selector = selectors.DefaultSelector()
+        partial_lines = {}
+        for pipe, prefix in [(self.out, '<out> '), (self.err, '<err> ')]:
+            selector.register(pipe, selectors.EVENT_READ, prefix)
+            partial_lines[prefix] = b''
+        try:
+            while selector.get_map():
+                timeout = None
+                if self.batch_started is not None:
+                    timeout = max(0, self.batch_started +
+                                  self.max_batch_delay - time.time())
+                for key, _ in selector.select(timeout):
+                    prefix = key.data
+                    data = os.read(key.fd, self.read_size)
+                    if not data:
+                        selector.unregister(key.fileobj)
+                        key.fileobj.close()
+                        if partial_lines[prefix]:
+                            self.handle_line(prefix, partial_lines[prefix])
+                        continue
+                    lines = (partial_lines[prefix] + data).split(b'\n')
+                    partial_lines[prefix] = lines.pop()
+                    for line in lines:
+                        self.handle_line(prefix, line + b'\n')
+                self.flush_if_due()
+        finally:
+            selector.close()
+            self.flush()
+
+    def handle_line(self, prefix, line):
+        if self.buffer is not None and prefix == '<out> ':
+            self.buffer.write(line)
+            return
+        line = line.decode('utf-8').rstrip('\n')
+        if self.err_handler and prefix == '<err> ':
+            self.err_handler(line)
+        if self.batch_started is None:
+            self.batch_started = time.time()
+        self.batch.append(prefix + line)
+        self.batch_size += len(line)
+        if self.batch_size >= self.max_batch_size:
+            self.flush()
+
+    def flush_if_due(self):
+        if self.batch_started is not None and \
+                time.time() - self.batch_started >= self.max_batch_delay:
+            self.flush()
+
+    def flush(self):
+        if self.batch:
+            self.logger.info('\n'.join(self.batch))
+        self.batch = []
+        self.batch_size = 0
+        self.batch_started = None
+
+
+class TerraformEventsParser(object):
+    """Parses the machine readable UI events of terraform plan and apply,
+    when they are run with -json, and logs the progress and the timings of
+    the resources, rather than every line of the output.
+    Returns the elapsed seconds of each applied resource, by its address.
+    The resources are applied in parallel, so the time of the whole run is
+    measured from its first event to its last.
+    """
+
+    # Log the progress every so many applied resources.
+    progress_interval = 10
+    slowest_count = 5
+    clock = staticmethod(time.time)
+
+    def __init__(self, logger, diagnostic_handler=None):
+        self.logger = logger
+        # Called with the text of each diagnostic and errored resource.
+        self.diagnostic_handler = diagnostic_handler
+        self.timings = {}
+        self.started = 0
+        self.first_event_time = None
+        self.last_event_time = None
+
+    def __call__(self, out):
+        for line in out:
+            self.handle_line(line)
+        return self.finish()
+
+    def handle_line(self, line):
+        line = line.decode('utf-8').rstrip('\n')
+        try:
+            event = json.loads(line)
+        except ValueError:
+            self.logger.info('<out> {0}'.format(line))
+            return
+        self.last_event_time = self.clock()
+        if self.first_event_time is None:
+            self.first_event_time = self.last_event_time
+        event_type = event.get('type')
+        message = event.get('@message', '')
+        hook = event.get('hook', {})
+        address = hook.get('resource', {}).get('addr')
+        if event_type == 'apply_start':
+            self.started += 1
+        elif event_type == 'apply_complete':
+            self.timings[address] = hook.get('elapsed_seconds', 0)
+            if len(self.timings) % self.progress_interval == 0:
+                self.logger.info(
+                    'Applied {done} of {started} started resources.'
+                    .format(done=len(self.timings), started=self.started))
+        elif event_type == 'apply_errored':
+            self.logger.error(message)
+            if self.diagnostic_handler:
+                self.diagnostic_handler(message)
+        elif event_type == 'diagnostic':
+            diagnostic = event.get('diagnostic', {})
+            log = self.logger.error \
+                if diagnostic.get('severity') == 'error' \
+                else self.logger.warning
+            text = '{0} {1}'.format(
+                message, diagnostic.get('detail', '')).strip()
+            log(text)
+            if self.diagnostic_handler:
+                self.diagnostic_handler(text)
+        elif event_type == 'change_summary':
+            self.logger.info(message)
+        else:
+            self.logger.debug(message)
+
+    def finish(self):
+        if self.timings:
+            slowest = sorted(self.timings.items(),
+                             key=lambda timing: timing[1],
+                             reverse=True)[:self.slowest_count]
+            self.logger.info(
+                'Applied {count} resources in {seconds:.1f}s; the slowest: '
+                '{slowest}.'.format(
+                    count=len(self.timings),
+                    seconds=self.last_event_time - self.first_event_time,
+                    slowest=', '.join('{0} ({1}s)'.format(*timing)
+                                      for timing in slowest)))
+        return self.timings
+
+
+class ParsingOutputConsumer(OutputConsumer):
+    def __init__(self, out, parser):
+        OutputConsumer.__init__(self, out)
+        self.parser = parser
+        self.result = None
+        self.error = None
+        self.consumer.start()
+
+    def consume_output(self):
+        try:
+            self.result = self.parser(self.out)
+        except Exception as e:
+            self.error = e
+        # Whatever the parser left is drained, so that the process does not
+        # block on a full pipe.
+        for _ in self.out:
+            pass
+        self.out.close()
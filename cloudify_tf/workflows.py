@@ -14,12 +14,75 @@
 # limitations under the License.
 
 
+import time
+
+from cloudify.state import workflow_ctx
+
+# When each node instance's operation started, for the workflow log.
+_started_at = {}
+
+
+def _start_timer(node_instance_id):
+    _started_at[node_instance_id] = time.time()
+
+
+def _log_elapsed(node_instance_id, operation):
+    started_at = _started_at.pop(node_instance_id, None)
+    if started_at is None:
+        # The workflow was resumed in between.
+        return
+    workflow_ctx.logger.info(
+        "Node instance %s finished %s in %.1f seconds.",
+        node_instance_id, operation, time.time() - started_at)
+
+
+def _dependency_order(node_instances):
+    """Order the node instances so that each one comes after the node
+    instances that it has relationships to, and return them along with
+    the ID's of those node instances.
+    """
+    by_id = dict((node_instance.id, node_instance)
+                 for node_instance in node_instances)
+    dependencies = {}
+    for node_instance in node_instances:
+        dependencies[node_instance.id] = set(
+            relationship.target_id
+            for relationship in node_instance.relationships
+            if relationship.target_id in by_id and
+            relationship.target_id != node_instance.id)
+    ordered = []
+    visited = set()
+
+    def visit(node_instance_id, path):
+        if node_instance_id in visited:
+            return
+        if node_instance_id in path:
+            # A relationship cycle; it is broken at this point.
+            return
+        path.add(node_instance_id)
+        for dependency_id in sorted(dependencies[node_instance_id]):
+            visit(dependency_id, path)
+        path.remove(node_instance_id)
+        visited.add(node_instance_id)
+        ordered.append(by_id[node_instance_id])
+
+    for node_instance in node_instances:
+        visit(node_instance.id, set())
+    return ordered, dependencies
+
+
 def _terraform_operation(ctx, operation, node_ids,
-                         node_instance_ids, **kwargs):
+                         node_instance_ids, max_concurrency=1, **kwargs):
+    """Execute the operation on the selected Module node instances,
+    at most max_concurrency of them at a time.
+    A node instance is only handled after the node instances that it has
+    relationships to.
+    """
+    max_concurrency = max(int(max_concurrency or 1), 1)
     graph = ctx.graph_mode()
-    sequence = graph.sequence()
     # Iterate over all node instances of type "cloudify.nodes.terraform.Module"
     # and refresh states.
+    node_instances = []
     for node_instance in ctx.node_instances:
         if node_ids and (node_instance.node.id not in node_ids):
             continue
@@ -27,27 +90,50 @@ def _terraform_operation(ctx, operation, node_ids,
             continue
         if 'cloudify.nodes.terraform.Module' in \
                 node_instance.node.type_hierarchy:
-            ctx.logger.info("Adding node instance: %s", node_instance.id)
-            sequence.add(
-                node_instance.execute_operation(
-                    operation,
-                    kwargs=kwargs,
-                    allow_kwargs_override=True)
-            )
+            node_instances.append(node_instance)
+
+    node_instances, dependencies = _dependency_order(node_instances)
+    subgraphs = {}
+    for index, node_instance in enumerate(node_instances):
+        ctx.logger.info("Adding node instance: %s", node_instance.id)
+        subgraph = graph.subgraph(
+            'terraform_{0}_{1}'.format(operation, node_instance.id))
+        sequence = subgraph.sequence()
+        sequence.add(
+            ctx.local_task(_start_timer,
+                           kwargs={'node_instance_id': node_instance.id}),
+            node_instance.execute_operation(
+                operation,
+                kwargs=kwargs,
+                allow_kwargs_override=True),
+            ctx.local_task(_log_elapsed,
+                           kwargs={'node_instance_id': node_instance.id,
+                                   'operation': operation}))
+        subgraphs[node_instance.id] = subgraph
+        for dependency_id in dependencies[node_instance.id]:
+            if dependency_id in subgraphs:
+                graph.add_dependency(subgraph, subgraphs[dependency_id])
+        # Each node instance waits for the one max_concurrency places
+        # before it, so at most max_concurrency of them run at once.
+        if index >= max_concurrency:
+            graph.add_dependency(
+                subgraph,
+                subgraphs[node_instances[index - max_concurrency].id])
 
     return graph
 
 
-def refresh_resources(ctx, node_ids, node_instance_ids):
+def refresh_resources(ctx, node_ids, node_instance_ids, max_concurrency=1):
     _terraform_operation(
         ctx,
         "terraform.refresh",
         node_ids,
-        node_instance_ids).execute()
+        node_instance_ids,
+        max_concurrency).execute()
 
 
 def reload_resources(ctx, node_ids, node_instance_ids,
-                     source, destroy_previous):
+                     source, destroy_previous, max_concurrency=1):
     kwargs = dict(destroy_previous=destroy_previous)
     if source:
         kwargs['source'] = source
@@ -56,4 +142,5 @@ def reload_resources(ctx, node_ids, node_instance_ids,
         "terraform.reload",
         node_ids,
         node_instance_ids,
+        max_concurrency,
         **kwargs).execute()